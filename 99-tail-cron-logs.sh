@@ -7,6 +7,7 @@ mkdir -p /var/log/repo
 touch /var/log/repo/update_mirror.log
 touch /var/log/repo/update_all_repos.log
 touch /var/log/repo/update_mashfiles.log
+touch /var/log/repo/repo_scheduler.log
 
 # Tail the logs in the background 
 # Note: This is very fragile, requires append-only operations to every log file
@@ -0,0 +1,423 @@
+#!/usr/bin/python3
+"""Benchmark update_mirror.py against fake mirrors on loopback.
+
+Each --mirror starts a local HTTP server that serves a synthetic repo tree
+with one behaviour:
+
+    good      serves every repo at the current revision
+    slow      like good, but every response is delayed (latency=0.5)
+    lagging   serves the revision before the current one
+    stale     serves a revision never published here, 2 days old
+    missing   404s a fraction of the repos (rate=0.3)
+    dead      resets every connection
+    flaky     resets a fraction of the requests (rate=0.1)
+    partial   serves fresh metadata but 404s a fraction of packages (rate=0.5)
+
+Any mirror also takes latency=SECS, e.g. --mirror missing:rate=0.5,latency=0.1.
+With --manifest every mirror also serves an osg/manifest.json of its repos;
+unlisted=FRACTION leaves that fraction of them out of it, as for tags
+published before the manifest existed.
+--origin adds origin replicas the same way; update_mirror.py lists all of
+them for repos none of them passed.
+
+update_mirror.py is then run against them, with a synthetic tag list and
+state in a scratch directory, and each run is reported with its wall time,
+the requests and connections the mirrors saw, and how accurately the
+resulting mirrorlists include exactly the mirrors that serve a fresh repo,
+and in how many of them a mirror was demoted to last place.
+Later runs reuse the state of earlier ones, as consecutive cron runs would.
+"""
+
+import argparse
+import gzip
+import hashlib
+import http.server
+import itertools
+import json
+import os
+import random
+import shutil
+import socket
+import socketserver
+import struct
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+bindir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin")
+sys.path.insert(0, bindir)
+from update_mirror import tagsplit
+
+kinds = {
+    # kind: default options
+    "good": {},
+    "slow": {"latency": 0.5},
+    "lagging": {},
+    "stale": {},
+    "missing": {"rate": 0.3},
+    "dead": {},
+    "flaky": {"rate": 0.1},
+    "partial": {"rate": 0.5},
+}
+default_mirrors = ["good", "slow", "lagging", "stale", "missing", "dead"]
+primary_size = 16384 #bytes of each fake primary metadata file
+packages = 20 #in each repo
+published = 1700000000 #revision of the previous publish; current is one later
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark update_mirror.py against fake mirrors on loopback",
+        epilog="Arguments after -- are passed to update_mirror.py.")
+    parser.add_argument("--mirror", action="append", dest="mirrors",
+        metavar="KIND[:OPT=VAL,...]",
+        help="add a fake mirror, one of %s; may be repeated (default: %s)"
+             % (", ".join(kinds), " ".join(default_mirrors)))
+    parser.add_argument("--origin", action="append", dest="origins",
+        metavar="KIND[:OPT=VAL,...]",
+        help="add a fake origin replica; may be repeated (default: good)")
+    parser.add_argument("--tags", type=int, default=50, metavar="N",
+        help="number of synthetic tags (default: %(default)s)")
+    parser.add_argument("--unpublished", type=float, default=0.1, metavar="FRACTION",
+        help="fraction of tags with no local repomd, judged by age "
+             "(default: %(default)s)")
+    parser.add_argument("--manifest", action="store_true",
+        help="have the mirrors serve a manifest of their repos")
+    parser.add_argument("--runs", type=int, default=2, metavar="N",
+        help="consecutive update_mirror.py runs (default: %(default)s)")
+    parser.add_argument("--seed", type=int, default=0,
+        help="random seed for the flaky and missing mirrors (default: %(default)s)")
+    parser.add_argument("--format", choices=["text", "json"], default="text",
+        help="output format (default: %(default)s)")
+    parser.add_argument("--keep", action="store_true",
+        help="keep the scratch directory and the update_mirror.py logs")
+    parser.add_argument("args", nargs="*", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    args.mirrors = [parse_mirror(spec) for spec in args.mirrors or default_mirrors]
+    args.origins = [parse_mirror(spec) for spec in args.origins or ["good"]]
+    return args
+
+def parse_mirror(spec):
+    kind, _, opts = spec.partition(":")
+    if kind not in kinds:
+        sys.exit("unknown mirror kind: "+kind)
+    options = dict(kinds[kind], latency=kinds[kind].get("latency", 0), unlisted=0)
+    for opt in filter(None, opts.split(",")):
+        name, _, value = opt.partition("=")
+        try:
+            options[name] = float(value)
+        except ValueError:
+            sys.exit("bad mirror option: "+opt)
+    return kind, options
+
+def synthetic_tags(count):
+    """Return count distinct tags that tagsplit() understands"""
+    combos = (itertools.product([series], ["el7", "el8", "el9"],
+                                ["release", "testing", "development", "contrib", "empty"])
+              for series in itertools.count())
+    return ["osg-3.%d-%s-%s" % combo
+            for combo in itertools.islice(itertools.chain.from_iterable(combos), count)]
+
+def repomd(revision, primary, timestamp):
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<repomd xmlns="http://linux.duke.edu/metadata/repo">\n'
+            '  <revision>%d</revision>\n'
+            '  <data type="primary">\n'
+            '    <checksum type="sha256">%s</checksum>\n'
+            '    <location href="repodata/%s-primary.xml.gz"/>\n'
+            '    <timestamp>%d</timestamp>\n'
+            '    <size>%d</size>\n'
+            '  </data>\n'
+            '</repomd>\n'
+            % (revision, primary, primary, timestamp, primary_size)).encode()
+
+def primary_xml():
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<metadata xmlns="http://linux.duke.edu/metadata/common" packages="%d">\n'
+            % packages
+            + "".join('<package type="rpm"><name>pkg%d</name>'
+                      '<location href="Packages/pkg%d-1.0-1.x86_64.rpm"/></package>\n'
+                      % (i, i) for i in range(packages))
+            + '</metadata>\n').encode()
+
+def checksum(key, revision):
+    return hashlib.sha256(("%s %d" % (key, revision)).encode()).hexdigest()
+
+def httpdate(t):
+    return time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(t))
+
+class Tree(object):
+    """The synthetic repos: their keys, and which have been published here"""
+
+    def __init__(self, tags, unpublished, rng):
+        self.keys = []
+        self.published = set()
+        for tag in tags:
+            key = '/'.join(tagsplit(tag) + ("x86_64",))
+            self.keys.append(key)
+            if rng.random() >= unpublished:
+                self.published.add(key)
+
+    def write(self, repodir, statedir):
+        """Publish the current revision locally, and record the previous
+        one in the state of update_mirror.py as if an earlier run saw it"""
+        history = {}
+        for key in self.published:
+            path = os.path.join(repodir, "osg", key, "repodata")
+            os.makedirs(path)
+            primary = checksum(key, published + 1)
+            with open(os.path.join(path, "repomd.xml"), "wb") as f:
+                f.write(repomd(published + 1, primary, published + 1))
+            with gzip.open(os.path.join(path, primary + "-primary.xml.gz"), "wb") as f:
+                f.write(primary_xml())
+            history[key] = [{"revision": str(published), "primary": checksum(key, published),
+                             "published": time.time() - 3600, "timestamp": published}]
+        with open(os.path.join(statedir, "mirror-revisions.json"), "w") as f:
+            json.dump(history, f)
+
+class Mirror(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, kind, options, tree, rng, manifest, origin=False):
+        http.server.HTTPServer.__init__(self, ("127.0.0.1", 0), MirrorHandler)
+        self.kind = kind
+        self.options = options
+        self.tree = tree
+        self.rng = rng
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+        self.started = time.time()
+        self.manifest = manifest
+        self.origin = origin
+        # the missing mirror 404s the same repos on every run
+        self.missing = set()
+        if kind == "missing":
+            self.missing = set(key for key in tree.keys
+                               if rng.random() < options["rate"])
+        self.url = "http://127.0.0.1:%d" % self.server_address[1]
+        self.name = "%s%s@%d" % ("origin-" if origin else "", kind, self.server_address[1])
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def expect(self, key, timeout):
+        """Whether this mirror should be listed for key"""
+        if self.kind in ("stale", "dead"):
+            return False
+        if key in self.missing:
+            return False
+        return self.options["latency"] < timeout
+
+    def serves(self, key):
+        """Return the revision and Last-Modified time this mirror serves
+        for key, or None"""
+        if key not in self.tree.keys or key in self.missing:
+            return None
+        if self.kind == "stale":
+            return published - 1000, self.started - 2 * 86400
+        if self.kind == "lagging" and key in self.tree.published:
+            return published, self.started - 3600
+        return published + 1, self.started - 60
+
+    def has_package(self, path):
+        if self.kind != "partial":
+            return True
+        fraction = int(hashlib.sha1(path.encode()).hexdigest()[:8], 16) / float(16 ** 8)
+        return fraction >= self.options["rate"]
+
+    def manifest_json(self):
+        repos = {}
+        for key in self.tree.keys:
+            served = self.serves(key)
+            unlisted = int(hashlib.sha1(key.encode()).hexdigest()[8:16], 16) / float(16 ** 8)
+            if served and unlisted >= self.options["unlisted"]:
+                revision, modified = served
+                repos[key] = {"revision": str(revision), "primary": checksum(key, revision),
+                              "timestamp": revision, "published": modified}
+        return json.dumps({"version": 1, "generated": self.started, "repos": repos}).encode()
+
+    def reset(self):
+        with self.lock:
+            if self.kind == "dead":
+                return True
+            return self.kind == "flaky" and self.rng.random() < self.options["rate"]
+
+class MirrorHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        http.server.BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def handle_one_request(self):
+        # read the request line first, so an idle keep-alive connection
+        # closing does not count as a request
+        self.raw_requestline = self.rfile.readline(65537)
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        with self.server.lock:
+            self.server.requests += 1
+        if self.server.reset():
+            self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                       struct.pack("ii", 1, 0))
+            self.close_connection = True
+            return
+        if not self.parse_request():
+            return
+        if self.server.options["latency"]:
+            time.sleep(self.server.options["latency"])
+        method = getattr(self, "do_" + self.command, None)
+        if method is None:
+            self.send_error(501)
+        else:
+            method()
+        self.wfile.flush()
+
+    def do_GET(self):
+        server = self.server
+        path = self.path.split("?", 1)[0]
+        if path == "/osg/":
+            return self.send(200, b"", server.started)
+        if path == "/osg/manifest.json" and server.manifest:
+            return self.send(200, server.manifest_json(), server.started)
+        parts = path.strip("/").split("/")
+        if parts[:1] != ["osg"] or len(parts) < 7 or parts[-2] not in ("repodata", "Packages"):
+            return self.send(404)
+        key = '/'.join(parts[1:-2])
+        served = server.serves(key)
+        if not served:
+            return self.send(404)
+        revision, modified = served
+        if parts[-2] == "Packages":
+            return self.send(200 if server.has_package(path) else 404, b"", modified)
+        primary = checksum(key, revision)
+        if parts[-1] == "repomd.xml":
+            self.send(200, repomd(revision, primary, revision), modified)
+        elif parts[-1] == primary + "-primary.xml.gz":
+            self.send(200, b"\0" * primary_size, modified)
+        else:
+            self.send(404)
+
+    do_HEAD = do_GET
+
+    def send(self, status, body=b"", modified=None):
+        """Respond like a static web server, keeping the connection open"""
+        if modified and self.headers.get("If-Modified-Since") == httpdate(modified):
+            status, body = 304, b""
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        if modified:
+            self.send_header("Last-Modified", httpdate(modified))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def run(args, run, workdir, mirrors, tree):
+    logpath = os.path.join(workdir, "update_mirror.%d.log" % run)
+    command = [sys.executable, os.path.join(bindir, "update_mirror.py"),
+               "--tags-file", os.path.join(workdir, "osg-tags"),
+               "--lock-file", os.path.join(workdir, "update-mirror.lk"),
+               "--repo-dir", os.path.join(workdir, "repo"),
+               "--mirror-dir", os.path.join(workdir, "mirror"),
+               "--state-dir", os.path.join(workdir, "state")]
+    for mirror in mirrors:
+        command += ["--origin" if mirror.origin else "--host", mirror.url]
+    command += args.args
+    for mirror in mirrors:
+        mirror.requests = mirror.connections = 0
+
+    started = time.monotonic()
+    with open(logpath, "w") as log:
+        status = subprocess.call(command, stdout=log, stderr=subprocess.STDOUT)
+    elapsed = time.monotonic() - started
+    if status:
+        sys.exit("update_mirror.py exited with %d, see %s" % (status, logpath))
+
+    with open(os.path.join(workdir, "state", "mirrorlist.json")) as f:
+        repos = json.load(f)["repos"]
+    timeout = float(args.args[args.args.index("--timeout") + 1]) \
+        if "--timeout" in args.args else 10
+    result = {"run": run, "seconds": round(elapsed, 3), "mirrors": []}
+    for mirror in mirrors:
+        stats = {"mirror": mirror.name, "requests": mirror.requests,
+                 "connections": mirror.connections, "expected": 0, "listed": 0,
+                 "false_positive": 0, "false_negative": 0, "demoted": 0}
+        for key in tree.keys:
+            expected = mirror.expect(key, timeout)
+            if mirror.origin and not any(m.expect(key, timeout) for m in mirrors if m.origin):
+                expected = True
+            weights = [weight for url, weight in repos.get(key, [])
+                       if url.startswith(mirror.url + "/")]
+            listed = bool(weights)
+            stats["demoted"] += listed and weights[0] == 0
+            stats["expected"] += expected
+            stats["listed"] += listed
+            if listed and not expected:
+                stats["false_positive"] += 1
+            elif expected and not listed:
+                stats["false_negative"] += 1
+        result["mirrors"].append(stats)
+    total = len(tree.keys) * len(mirrors)
+    wrong = sum(m["false_positive"] + m["false_negative"] for m in result["mirrors"])
+    result["requests"] = sum(m["requests"] for m in result["mirrors"])
+    result["connections"] = sum(m["connections"] for m in result["mirrors"])
+    result["accuracy"] = round(1 - float(wrong) / total, 4) if total else 1.0
+    return result
+
+def print_results(results, format):
+    if format == "json":
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+    columns = ["mirror", "requests", "connections", "expected", "listed",
+               "false_positive", "false_negative", "demoted"]
+    for result in results:
+        print("run %d: %.2f seconds, %d requests over %d connections, accuracy %.1f%%"
+              % (result["run"], result["seconds"], result["requests"],
+                 result["connections"], 100 * result["accuracy"]))
+        rows = [columns] + [[str(m[c]) for c in columns] for m in result["mirrors"]]
+        widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+        for row in rows:
+            print("  " + "  ".join(cell.ljust(width) for cell, width in zip(row, widths)).rstrip())
+
+def main():
+    args = parse_args()
+    rng = random.Random(args.seed)
+
+    workdir = tempfile.mkdtemp(prefix="mirror_bench.")
+    try:
+        tags = synthetic_tags(args.tags)
+        with open(os.path.join(workdir, "osg-tags"), "w") as f:
+            f.write("".join(tag+"\n" for tag in tags))
+        tree = Tree(tags, args.unpublished, rng)
+        os.makedirs(os.path.join(workdir, "state"))
+        os.makedirs(os.path.join(workdir, "mirror"))
+        tree.write(os.path.join(workdir, "repo"), os.path.join(workdir, "state"))
+
+        mirrors = [Mirror(kind, options, tree, rng, args.manifest, origin=True)
+                   for kind, options in args.origins]
+        mirrors += [Mirror(kind, options, tree, rng, args.manifest)
+                    for kind, options in args.mirrors]
+        for mirror in mirrors:
+            mirror.start()
+        results = [run(args, i + 1, workdir, mirrors, tree) for i in range(args.runs)]
+        for mirror in mirrors:
+            mirror.shutdown()
+        print_results(results, args.format)
+    finally:
+        if args.keep:
+            print("kept "+workdir, file=sys.stderr)
+        else:
+            shutil.rmtree(workdir)
+
+if __name__ == "__main__":
+    main()
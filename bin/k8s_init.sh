@@ -16,6 +16,10 @@ err_exit() {
 }
 trap 'err_exit' ERR
 
+# State for the repo scripts (/var/lib/repo links here), needed by the
+# daemon even when the sync below is skipped
+mkdir -p "$REPO_BASEDIR/state"
+
 # Was timestamp file modified less than $REPO_MAXAGE minutes ago?
 if test "$(find $REPO_TIMESTAMP -mmin -$REPO_MAXAGE)" ; then
     echo "Repo is current. Skipping sync."
@@ -32,15 +36,15 @@ mkdir -p "$REPO_BASEDIR/mash" \
 # Generate mash config files
 update_mashfiles.sh
 
-# Reorder mash tags for less lock contention
-rev /etc/osg-koji-tags/osg-tags | sort | rev > /tmp/osg-tags
-
-# Download repo data in parallel
-parallel --max-procs 12 --results /tmp/init --arg-file /tmp/osg-tags --retries 10 update_repo.sh {}
+# Download repo data in parallel, one tag per SERIES.DVER lock group at a time
+repo_scheduler.py --all --jobs 12 --retries 10
 
 # Add symlink for mirrorlist
 ln --no-target-directory --force --symbolic "$REPO_BASEDIR/mirror" "$REPO_BASEDIR/repo/mirror"
 
+# List every published repo in the manifest the mirror prober reads
+update_manifest.py --all --prune
+
 # Generate mirrorlist
 update_mirror.py
 
@@ -0,0 +1,191 @@
+#!/usr/bin/python3
+
+import argparse
+import hashlib
+import http.server
+import json
+import os
+import signal
+import socketserver
+import threading
+import time
+
+from update_mirror import log, weighted_order
+
+indexfile = "/var/lib/repo/mirrorlist.json"
+port = 8081
+max_age = 300 #seconds clients may cache a mirrorlist
+poll = 5 #seconds between checks for a new index
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Serve yum mirrorlists from the latest update_mirror.py run")
+    parser.add_argument("--index", default=indexfile, metavar="FILE",
+        help="mirrorlist index written by update_mirror.py (default: %(default)s)")
+    parser.add_argument("--bind", default="127.0.0.1", metavar="ADDR",
+        help="address to listen on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=port,
+        help="port to listen on (default: %(default)s)")
+    parser.add_argument("--max-age", type=int, default=max_age, metavar="SECS",
+        help="Cache-Control max-age of responses (default: %(default)s)")
+    parser.add_argument("--verbose", action="store_true",
+        help="log every request")
+    return parser.parse_args()
+
+class Snapshot(object):
+    """One generation of the index: what lookups read, never modified"""
+
+    def __init__(self, lists, shuffle, aliases, generated):
+        self.lists = lists
+        self.shuffle = shuffle
+        self.aliases = aliases
+        self.generated = generated
+
+def parse_index(data):
+    """Return the Snapshot of an index written by update_mirror.py, or
+    raise ValueError if it is not one"""
+    try:
+        lists = {}
+        for key, entries in data["repos"].items():
+            entries = [(str(url), float(weight)) for url, weight in entries]
+            etag = 'W/"%s"' % hashlib.sha1(repr(entries).encode()).hexdigest()
+            lists[key] = (entries, etag)
+        aliases = dict(data.get("aliases", {}))
+        generated = data.get("generated")
+        if generated is not None:
+            generated = float(generated)
+    except (AttributeError, KeyError, TypeError, ValueError) as e:
+        raise ValueError("bad index: "+repr(e))
+    return Snapshot(lists, data.get("order") == "weighted", aliases, generated)
+
+class Index(object):
+    """The mirrorlists of the last probe run, keyed by series/dver/repo/arch.
+
+    Each mirrorlist is a list of (url, weight) entries. With weighted
+    order, every response is shuffled so that hosts come first in
+    proportion to their weight; the ETag is weak, since responses differ
+    only in order within one generation.
+
+    The index file is replaced atomically by update_mirror.py; when its
+    identity changes a new Snapshot is built and swapped in as a single
+    reference, so requests always see one consistent generation.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.stat = None
+        self.current = Snapshot({}, False, {}, None)
+        self.lock = threading.Lock()
+
+    def reload(self, force=False):
+        try:
+            st = os.stat(self.path)
+        except OSError as e:
+            if self.stat is None:
+                log("no index yet: "+str(e))
+            return
+        stat = (st.st_ino, st.st_mtime, st.st_size)
+        with self.lock:
+            if stat == self.stat and not force:
+                return
+            try:
+                with open(self.path) as f:
+                    current = parse_index(json.load(f))
+            except (IOError, ValueError) as e:
+                log("cannot load "+self.path+": "+str(e))
+                # don't retry until it changes
+                self.stat = stat
+                return
+            # swap in the new generation in one assignment
+            self.current = current
+            self.stat = stat
+        log("loaded %d mirrorlists generated %s"
+            % (len(current.lists), time.ctime(current.generated) if current.generated else "(unknown)"))
+
+    def lookup(self, path):
+        """Return (body, etag) for a request path, or None.
+
+        Paths look like [/mirror]/osg/SERIES/DVER/REPO/ARCH, as under the
+        static mirrorlist tree.
+        """
+        current = self.current
+        parts = [p for p in path.split("?", 1)[0].split("/") if p]
+        if parts[:1] == ["mirror"]:
+            parts = parts[1:]
+        if parts[:1] != ["osg"] or len(parts) not in (4, 5):
+            return None
+        parts = parts[1:]
+        parts[0] = current.aliases.get(parts[0], parts[0])
+        if len(parts) == 3:
+            # series without a repo, like 23-contrib/el9//x86_64
+            parts.insert(2, "")
+        entry = current.lists.get('/'.join(parts))
+        if entry is None:
+            return None
+        entries, etag = entry
+        if current.shuffle:
+            urls = weighted_order(entries)
+        else:
+            urls = [url for url, weight in entries]
+        return "".join(url+"\n" for url in urls).encode(), etag
+
+    def watch(self, interval):
+        while True:
+            time.sleep(interval)
+            try:
+                self.reload()
+            except Exception as e:
+                log("cannot reload "+self.path+": "+repr(e))
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    server_version = "mirrorlist_server"
+    protocol_version = "HTTP/1.1"
+
+    def do_GET(self):
+        entry = self.server.index.lookup(self.path)
+        if entry is None:
+            self.send_error(404)
+            return
+        body, etag = entry
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.send_header("Cache-Control", "max-age=%d" % self.server.max_age)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    do_HEAD = do_GET
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            log("%s %s" % (self.address_string(), format % args))
+
+class Server(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+def main():
+    args = parse_args()
+
+    index = Index(args.index)
+    index.reload()
+    signal.signal(signal.SIGHUP, lambda signum, frame: index.reload(force=True))
+    watcher = threading.Thread(target=index.watch, args=(poll,))
+    watcher.daemon = True
+    watcher.start()
+
+    server = Server((args.bind, args.port), Handler)
+    server.index = index
+    server.max_age = args.max_age
+    server.verbose = args.verbose
+    log("serving mirrorlists on %s:%d" % (args.bind, args.port))
+    server.serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,940 @@
+#!/usr/bin/python3
+"""Run update_repo.sh over many tags with a pool of workers.
+
+update_repo.sh serializes tags of the same SERIES.DVER with a lock, so
+the scheduler never starts a tag while another of its lock group is
+running; it starts a tag of another group instead, keeping every worker
+busy while there is work any worker can do.
+
+How long each tag takes is remembered across runs, and the work expected
+to take longest is started first, so short tags fill in at the end of a
+cycle instead of one long tag running alone.
+
+Each tag also has a priority and a maximum age from the schedule file.
+Tags that will still be within their maximum age at the next run are
+skipped, and the most overdue tags of the highest priority go first.
+
+--jobs is only an upper bound: another tag is started only while the
+machine (or container) has CPU, memory and I/O headroom, and enough free
+memory for the peak RSS that tag reached before.
+
+update_repo.sh limits each of its phases with timeout(1); as a backstop,
+a run that takes longer than --timeout altogether is killed, session and
+all, so a stuck tag cannot hold its lock group forever.
+
+With --daemon it keeps running instead of doing one cycle: tags are
+queued as they come due, and the jobs cron used to start (mirrorlists,
+mashfiles, tarballs) run on their own timers. The daemon listens on
+localhost for requests to update a tag right away; --refresh TAG sends
+one, and with --wait follows it until the tag is published.
+"""
+
+import argparse
+import fcntl
+import fnmatch
+import http.server
+import json
+import math
+import os
+import queue
+import signal
+import socketserver
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.request
+
+from update_mirror import _log_lock, log, load_state, make_state_dir, save_state, tagsplit
+
+tagsfile = "/etc/osg-koji-tags/osg-tags"
+schedulefile = "/etc/repo-schedule.conf"
+bindir = os.path.dirname(os.path.abspath(__file__))
+update_repo = os.path.join(bindir, "update_repo.sh")
+statedir = "/var/lib/repo"
+repodir = "/usr/local/repo"
+lockdir = "/var/lock/repo"
+jobs = 1 #concurrent update_repo.sh runs
+interval = 30 #minutes until the next run, from cron
+max_load = 1.5 #1-minute load average per CPU above which no tag is started
+max_pressure = 40 #percent of time stalled on I/O or memory (PSI avg10)
+mem_reserve = 512 #MiB of memory to leave free
+default_rss = 1024 #MiB expected of a tag whose peak RSS was never seen
+poll = 2 #seconds between resource samples
+budget = 240 #minutes an update_repo.sh run may take before it is killed
+kill_grace = 60 #seconds between SIGTERM and SIGKILL of an overdue run
+retry_failed = 30 #minutes before the daemon retries a tag that failed
+
+timers = [
+    # jobs --daemon runs besides update_repo.sh, in place of etc/cron.d/repo:
+    # minutes between runs, command (from the same directory as this script);
+    # timers of the same script run one at a time, the one due longest first
+    (60, ["update_mirror.py"]),
+    (5, ["update_mirror.py", "--changed"]),
+    (60, ["update_tarball-install.sh"]),
+    (24 * 60, ["update_mashfiles.sh"]),
+]
+changed_delay = 60 #seconds after a publish to run update_mirror.py --changed
+control_port = 8082 #localhost port of the daemon's control API
+forced = 3 #priority of tags queued through the control API, above high
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run update_repo.sh for many tags in parallel, one tag "
+                    "per SERIES.DVER lock group at a time")
+    parser.add_argument("tags", nargs="*", metavar="TAG",
+        help="tags to update (default: all tags in --tags-file)")
+    parser.add_argument("--daemon", action="store_true",
+        help="keep running, updating tags as they come due and running the "
+             "mirror, tarball and mashfile jobs on timers")
+    parser.add_argument("--control-port", type=int, default=control_port,
+        metavar="PORT",
+        help="localhost port of the daemon's control API, 0 for none "
+             "(default: %(default)s)")
+    parser.add_argument("--refresh", action="append", default=[], metavar="TAG",
+        help="ask the running daemon to update TAG ahead of the schedule")
+    parser.add_argument("--wait", action="store_true",
+        help="with --refresh, wait until the tags are updated")
+    parser.add_argument("--repo-dir", default=repodir, metavar="DIR",
+        help="local repo tree, for the daemon's timestamp.txt "
+             "(default: %(default)s)")
+    parser.add_argument("--all", action="store_true",
+        help="update every tag, even those within their maximum age")
+    parser.add_argument("--interval", type=float, default=interval, metavar="MINUTES",
+        help="time until the next run; tags that would pass their maximum "
+             "age by then are updated now (default: %(default)s)")
+    parser.add_argument("-j", "--jobs", type=int, default=jobs, metavar="N",
+        help="maximum concurrent update_repo.sh runs (default: %(default)s)")
+    parser.add_argument("--max-load", type=float, default=max_load, metavar="LOAD",
+        help="do not start a tag while the load average per CPU is above "
+             "this (default: %(default)s)")
+    parser.add_argument("--max-pressure", type=float, default=max_pressure,
+        metavar="PCT",
+        help="do not start a tag while I/O or memory pressure is above this "
+             "(default: %(default)s)")
+    parser.add_argument("--mem-reserve", type=float, default=mem_reserve,
+        metavar="MIB",
+        help="memory to keep free beyond the expected peak RSS of the "
+             "running tags (default: %(default)s)")
+    parser.add_argument("--timeout", type=float, default=budget, metavar="MINUTES",
+        help="kill an update_repo.sh run that takes longer, 0 for no limit "
+             "(default: %(default)s)")
+    parser.add_argument("--retries", type=int, default=0, metavar="N",
+        help="retry a failed tag up to N times, after the other tags "
+             "(default: %(default)s)")
+    parser.add_argument("--tags-file", default=tagsfile, metavar="FILE",
+        help="koji tags to update (default: %(default)s)")
+    parser.add_argument("--schedule", default=schedulefile, metavar="FILE",
+        help="tag priorities and maximum ages (default: %(default)s)")
+    parser.add_argument("--state-dir", default=statedir, metavar="DIR",
+        help="where tag run times are kept between runs (default: %(default)s)")
+    parser.add_argument("--update-repo", default=update_repo, metavar="PATH",
+        help="update_repo.sh to run (default: %(default)s)")
+    args = parser.parse_args()
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    return args
+
+def relay(proc, prefix):
+    """Copy the output of proc to stdout line by line, prefixed, and return
+    its exit status"""
+    for line in proc.stdout:
+        with _log_lock:
+            sys.stdout.write(prefix + line.decode("utf-8", "replace"))
+            sys.stdout.flush()
+    return proc.wait()
+
+def read_tags(path):
+    """Return the tags in path, last first like update_all_repos.sh did"""
+    with open(path) as f:
+        tags = [line.rstrip("\n").split(":")[0] for line in f]
+    return [tag for tag in reversed(tags) if tag]
+
+def lock_group(tag):
+    """Return the SERIES.DVER lock group update_repo.sh uses for tag"""
+    try:
+        series,dver,repo = tagsplit(tag)
+    except ValueError:
+        # update_repo.sh will reject it; let it run alone
+        return tag
+    return series+"."+dver
+
+class Durations(object):
+    """Smoothed update_repo.sh run time of each tag, kept across runs."""
+
+    alpha = 0.3 #weight of the newest run
+
+    def __init__(self, path):
+        self.path = path
+        self.tags = load_state(path, {})
+
+    def update(self, tag, seconds):
+        old = self.tags.get(tag)
+        self.tags[tag] = seconds if old is None else old + self.alpha * (seconds - old)
+
+    def predict(self, tag):
+        """Return the expected run time of tag; tags never run are
+        expected to take the median time"""
+        if tag in self.tags:
+            return self.tags[tag]
+        return statistics.median(self.tags.values()) if self.tags else 0
+
+    def save(self):
+        save_state(self.path, self.tags)
+
+class Schedule(object):
+    """Priority and maximum age of each tag, from lines of
+
+        PATTERN PRIORITY MAX-AGE
+
+    where PATTERN is a shell pattern matched against the tag, PRIORITY is
+    high, normal or low and MAX-AGE is in minutes. The first matching line
+    wins; tags matching no line are normal with a 30 minute maximum age.
+    """
+
+    priorities = {"high": 2, "normal": 1, "low": 0}
+    default = ("normal", 30)
+
+    def __init__(self, path):
+        self.rules = []
+        try:
+            f = open(path)
+        except FileNotFoundError:
+            log("no schedule file "+path+", using defaults")
+            return
+        with f:
+            for n, line in enumerate(f, 1):
+                fields = line.split("#", 1)[0].split()
+                if not fields:
+                    continue
+                try:
+                    pattern, priority, max_age = fields
+                    self.priorities[priority]
+                    self.rules.append((pattern, priority, float(max_age)))
+                except (ValueError, KeyError):
+                    log("%s:%d: bad schedule line: %s" % (path, n, line.strip()))
+
+    def lookup(self, tag):
+        """Return the priority and maximum age in seconds of tag"""
+        for pattern, priority, max_age in self.rules:
+            if fnmatch.fnmatchcase(tag, pattern):
+                break
+        else:
+            priority, max_age = self.default
+        return self.priorities[priority], max_age * 60
+
+class Updated(object):
+    """When the last successful update of each tag started, kept across
+    runs."""
+
+    def __init__(self, path):
+        self.path = path
+        self.tags = load_state(path, {})
+        self.count = 0
+
+    def age(self, tag):
+        """Return seconds since tag was updated, or None if never"""
+        if tag not in self.tags:
+            return None
+        return time.time() - self.tags[tag]
+
+    def update(self, tag, when):
+        self.tags[tag] = when
+        self.count += 1
+
+    def save(self):
+        save_state(self.path, self.tags)
+
+def read_first(*paths):
+    """Return the stripped contents of the first readable path, or None"""
+    for path in paths:
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except (IOError, OSError):
+            pass
+    return None
+
+def read_keyed(path):
+    """Return the 'key value' lines of a /proc or cgroup file as a dict"""
+    values = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                fields = line.replace(":", " ").split()
+                if len(fields) >= 2 and fields[1].isdigit():
+                    values[fields[0]] = int(fields[1])
+    except (IOError, OSError):
+        pass
+    return values
+
+def session_procs(sid):
+    """Return {pid: RSS in bytes} of the processes in session sid.
+
+    Jobs are started in a session of their own; a session, unlike a
+    process group, also holds the commands update_repo.sh runs under
+    timeout(1), which puts them in process groups of their own.
+    """
+    procs = {}
+    for pid in os.listdir("/proc"):
+        if not pid.isdigit():
+            continue
+        try:
+            with open("/proc/"+pid+"/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+        except (IOError, OSError, IndexError):
+            continue
+        # fields start with the state: session is field 6 of stat, rss 24
+        if int(fields[3]) == sid:
+            procs[int(pid)] = int(fields[21]) * os.sysconf("SC_PAGE_SIZE")
+    return procs
+
+def kill_session(sid, sig=signal.SIGTERM):
+    for pid in session_procs(sid):
+        try:
+            os.kill(pid, sig)
+        except OSError:
+            pass
+
+class Admission(object):
+    """Whether another update_repo.sh may start, from live CPU, memory and
+    I/O headroom, within the limits of the container's cgroup if any."""
+
+    def __init__(self, max_load, max_pressure, mem_reserve):
+        self.max_load = max_load
+        self.max_pressure = max_pressure
+        self.mem_reserve = mem_reserve
+
+    def cpus(self):
+        cpus = float(len(os.sched_getaffinity(0)))
+        quota = read_first("/sys/fs/cgroup/cpu.max")
+        if quota and not quota.startswith("max"):
+            limit, period = quota.split()[:2]
+            cpus = min(cpus, float(limit) / float(period))
+        quota = read_first("/sys/fs/cgroup/cpu/cpu.cfs_quota_us")
+        period = read_first("/sys/fs/cgroup/cpu/cpu.cfs_period_us")
+        if quota and period and int(quota) > 0:
+            cpus = min(cpus, float(quota) / float(period))
+        return max(cpus, 1.0)
+
+    def mem_available(self):
+        """Return the bytes of memory that can still be used"""
+        available = read_keyed("/proc/meminfo").get("MemAvailable", 0) * 1024
+        for limit, usage, stat, inactive in (
+                ("/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory.current",
+                 "/sys/fs/cgroup/memory.stat", "inactive_file"),
+                ("/sys/fs/cgroup/memory/memory.limit_in_bytes",
+                 "/sys/fs/cgroup/memory/memory.usage_in_bytes",
+                 "/sys/fs/cgroup/memory/memory.stat", "total_inactive_file")):
+            limit, usage = read_first(limit), read_first(usage)
+            # cgroup v1 reports no limit as a huge number
+            if limit and limit.isdigit() and usage and usage.isdigit() \
+                    and int(limit) < 2**60:
+                # like the OOM killer, don't count reclaimable page cache
+                used = int(usage) - read_keyed(stat).get(inactive, 0)
+                available = min(available, int(limit) - used)
+        return available
+
+    def pressure(self, resource):
+        """Return the PSI some avg10 percentage of resource, or None"""
+        line = read_first("/sys/fs/cgroup/%s.pressure" % resource,
+                          "/proc/pressure/%s" % resource)
+        if not line:
+            return None
+        for field in line.splitlines()[0].split():
+            if field.startswith("avg10="):
+                return float(field[6:])
+        return None
+
+    def check(self, need, reserved):
+        """Return None if a tag expected to need `need` bytes may start
+        while the running tags may still grow by `reserved` bytes, or the
+        reason it may not"""
+        load = os.getloadavg()[0] / self.cpus()
+        if load > self.max_load:
+            return "load %.2f per CPU" % load
+        for resource in ("io", "memory"):
+            pressure = self.pressure(resource)
+            if pressure is not None and pressure > self.max_pressure:
+                return "%s pressure %.0f%%" % (resource, pressure)
+        free = self.mem_available() - reserved - self.mem_reserve
+        if need > free:
+            # peaks are smoothed, so these may be floats
+            return "%.0f MiB free, %.0f MiB needed" % (free / 2**20, need / 2**20)
+        return None
+
+class PeakRSS(object):
+    """Peak RSS of each tag's update_repo.sh process group, kept across
+    runs. Growth is taken at once and shrinking smoothed, to stay on the
+    safe side of the OOM killer."""
+
+    alpha = 0.3 #weight of the newest run when the peak shrinks
+
+    def __init__(self, path, default):
+        self.path = path
+        self.default = default
+        self.tags = load_state(path, {})
+
+    def update(self, tag, peak):
+        old = self.tags.get(tag)
+        self.tags[tag] = peak if old is None or peak > old else old + self.alpha * (peak - old)
+
+    def predict(self, tag):
+        if tag in self.tags:
+            return self.tags[tag]
+        return statistics.median(self.tags.values()) if self.tags else self.default
+
+    def save(self):
+        save_state(self.path, self.tags)
+
+class Job(object):
+    def __init__(self, tag, priority=1, lateness=0):
+        self.tag = tag
+        self.group = lock_group(tag)
+        self.priority = priority
+        self.lateness = lateness
+        self.attempts = 0
+        self.status = None
+        self.killed = False
+        self.pid = None
+        self.rss = 0
+        self.peak = 0
+
+class Scheduler(object):
+    """A pool of workers running update_repo.sh, one job per lock group
+    at a time.
+
+    The next job is the one with the highest priority, then the most
+    maximum ages overdue. Among equally urgent jobs, since the tags of a
+    lock group run one after another and a cycle takes at least as long as
+    its busiest group, the job is taken from the idle group with the most
+    predicted work left, longest job first. Retries go after all first
+    attempts.
+
+    Each job runs in its own thread, which relays the output of
+    update_repo.sh line by line with a [update_repo.sh TAG] prefix and
+    reports back when it exits. Meanwhile the RSS of each job's session
+    is sampled, jobs running longer than `budget` seconds are killed, and
+    more jobs are started, up to `workers`, whenever admission allows.
+    """
+
+    def __init__(self, command, workers, retries, durations, updated,
+                 admission, peaks, budget=0):
+        self.command = command
+        self.budget = budget
+        self.durations = durations
+        self.updated = updated
+        self.admission = admission
+        self.peaks = peaks
+        self.held = None
+        self.sampled = 0
+        self.workers = workers
+        self.retries = retries
+        self.queue = []
+        self.running = {}
+        self.finished = queue.Queue()
+        self.failed = []
+        self.results = {}
+        self.lock = threading.Lock()
+
+    def add(self, tag, priority=1, lateness=0):
+        self.queue.append(Job(tag, priority, lateness))
+
+    def pending(self, tag):
+        return tag in self.running or any(job.tag == tag for job in self.queue)
+
+    def kill(self, sig=signal.SIGTERM):
+        """Signal the sessions of all running jobs"""
+        for job in list(self.running.values()):
+            if job.pid:
+                kill_session(job.pid, sig)
+
+    def order(self):
+        """Return the queued jobs, the one to start first first"""
+        left = {}
+        for job in self.queue:
+            left[job.group] = left.get(job.group, 0) + self.durations.predict(job.tag)
+        return sorted(self.queue, key=lambda job: (job.attempts > 0, -job.priority, -job.lateness,
+                                                   -left[job.group], -self.durations.predict(job.tag)))
+
+    def next_job(self):
+        busy = set(job.group for job in self.running.values())
+        for job in self.order():
+            if job.group not in busy:
+                return job
+        return None
+
+    def admit(self, job):
+        """Return whether job may start now"""
+        if not self.running:
+            return True
+        reserved = sum(max(self.peaks.predict(j.tag) - j.rss, 0)
+                       for j in self.running.values())
+        held = self.admission.check(self.peaks.predict(job.tag), reserved)
+        if held and self.held != job.tag:
+            log("holding %s with %d running: %s" % (job.tag, len(self.running), held))
+        self.held = job.tag if held else None
+        return held is None
+
+    def sample(self):
+        self.sampled = time.monotonic()
+        for job in list(self.running.values()):
+            if job.pid:
+                job.rss = sum(session_procs(job.pid).values())
+                job.peak = max(job.peak, job.rss)
+                self.watch(job)
+
+    def watch(self, job):
+        """Kill job if it is over budget: SIGTERM first, so update_repo.sh
+        cleans up, then SIGKILL after kill_grace seconds"""
+        over = time.monotonic() - job.started - self.budget
+        if not self.budget or over < 0:
+            return
+        if not job.killed:
+            log("killing update_repo.sh for %s after %d minutes"
+                % (job.tag, self.budget // 60))
+            kill_session(job.pid)
+            job.killed = True
+        elif over >= kill_grace:
+            kill_session(job.pid, signal.SIGKILL)
+
+    def start(self, job):
+        job.attempts += 1
+        job.killed = False
+        job.started = time.monotonic()
+        job.started_at = time.time()
+        self.running[job.tag] = job
+        log("Running update_repo.sh for tag %s ..." % job.tag
+            + (" (attempt %d)" % job.attempts if job.attempts > 1 else ""))
+        thread = threading.Thread(target=self.run_job, args=(job,))
+        thread.daemon = True
+        thread.start()
+
+    def run_job(self, job):
+        prefix = "[update_repo.sh %s] " % job.tag
+        try:
+            proc = subprocess.Popen([self.command, job.tag], stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT, start_new_session=True)
+            job.pid = proc.pid
+            job.status = relay(proc, prefix)
+        except OSError as e:
+            log("cannot run %s for %s: %s" % (self.command, job.tag, e))
+            job.status = 127
+        self.finished.put(job)
+
+    def finish(self, job):
+        del self.running[job.tag]
+        elapsed = time.monotonic() - job.started
+        if job.status == 0:
+            log("Finished %s in %d seconds, peak RSS %d MiB"
+                % (job.tag, elapsed, job.peak >> 20))
+            self.durations.update(job.tag, elapsed)
+            self.durations.save()
+            self.updated.update(job.tag, job.started_at)
+            self.updated.save()
+            self.results[job.tag] = (job.status, time.time())
+            if job.peak:
+                self.peaks.update(job.tag, job.peak)
+                self.peaks.save()
+        elif job.attempts <= self.retries:
+            log("update_repo.sh failed for %s with status %d, will retry"
+                % (job.tag, job.status))
+            self.queue.append(job)
+        else:
+            log("mash failed for %s - please see error log" % job.tag)
+            self.failed.append(job.tag)
+            self.results[job.tag] = (job.status, time.time())
+
+    def run(self, refill=None):
+        """Run jobs until there are none left, or forever with refill,
+        which is called on every pass to queue more"""
+        while self.queue or self.running or refill:
+            with self.lock:
+                if refill:
+                    refill()
+                while len(self.running) < self.workers:
+                    job = self.next_job()
+                    if job is None or not self.admit(job):
+                        break
+                    self.queue.remove(job)
+                    self.start(job)
+            try:
+                job = self.finished.get(timeout=poll)
+            except queue.Empty:
+                job = None
+            with self.lock:
+                if job:
+                    self.finish(job)
+                if time.monotonic() - self.sampled >= poll:
+                    self.sample()
+        return not self.failed
+
+def due_tags(tags, schedule, updated, lookahead):
+    """Return (tag, priority, lateness) of the tags that will be past their
+    maximum age within lookahead seconds, most overdue first"""
+    due = []
+    for tag in tags:
+        priority, max_age = schedule.lookup(tag)
+        age = updated.age(tag)
+        if age is not None and age + lookahead < max_age:
+            continue
+        # whole maximum ages overdue; never updated is the most overdue
+        lateness = math.inf if age is None else math.floor(age / max(max_age, 1))
+        due.append((tag, priority, lateness))
+    return due
+
+class Timer(object):
+    """A command run every `period` seconds, one instance at a time"""
+
+    def __init__(self, period, command):
+        self.period = period
+        self.command = command
+        self.name = " ".join(command)
+        self.next = time.monotonic()
+        self.running = False
+        self.proc = None
+
+    def poll(self, busy):
+        """Start the command if it is due and its script is not in busy;
+        return whether it is running"""
+        if not self.running and self.command[0] not in busy \
+                and time.monotonic() >= self.next:
+            self.next = time.monotonic() + self.period
+            self.running = True
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+        return self.running
+
+    def soon(self, delay):
+        self.next = min(self.next, time.monotonic() + delay)
+
+    def run(self):
+        command = [os.path.join(bindir, self.command[0])] + self.command[1:]
+        try:
+            self.proc = subprocess.Popen(command, stdout=subprocess.PIPE,
+                                         stderr=subprocess.STDOUT, start_new_session=True)
+            status = relay(self.proc, "[%s] " % self.name)
+        except OSError as e:
+            log("cannot run %s: %s" % (self.name, e))
+            status = 127
+        if status:
+            log("%s exited with status %d" % (self.name, status))
+        self.proc = None
+        self.running = False
+
+    def kill(self, sig=signal.SIGTERM):
+        proc = self.proc
+        if proc:
+            kill_session(proc.pid, sig)
+
+class Stopped(Exception):
+    """Raised in the daemon's main thread by SIGTERM or SIGINT"""
+
+class Daemon(object):
+    """Keeps the scheduler fed with due tags, and runs the timers.
+
+    The tag list and schedule are reread when their files change; run
+    times, ages and peak RSS stay in memory. A tag whose retries are used
+    up waits retry_failed minutes before it is queued again. Whenever the
+    queue drains without failures, timestamp.txt is updated like
+    update_all_repos.sh does after a successful cycle.
+    """
+
+    def __init__(self, scheduler, schedule_path, tags_path, updated, repodir):
+        self.scheduler = scheduler
+        self.schedule_path = schedule_path
+        self.tags_path = tags_path
+        self.updated = updated
+        self.repodir = repodir
+        self.timers = [Timer(minutes * 60, command) for minutes, command in timers]
+        self.changed = [timer for timer in self.timers if "--changed" in timer.command]
+        self.loaded = {}
+        self.tags = []
+        self.schedule = None
+        self.failed = {}
+        self.busy = False
+        self.clean = True
+        self.published = 0
+
+    def reload(self, path):
+        """Return whether path changed since it was last loaded"""
+        try:
+            mtime = os.stat(path).st_mtime
+        except OSError:
+            mtime = None
+        if self.loaded.get(path, -1) == mtime:
+            return False
+        self.loaded[path] = mtime
+        return True
+
+    def refill(self):
+        scheduler = self.scheduler
+        if self.reload(self.tags_path):
+            try:
+                self.tags = read_tags(self.tags_path)
+                log("loaded %d tags from %s" % (len(self.tags), self.tags_path))
+            except IOError as e:
+                log("cannot read tags: "+str(e))
+        if self.reload(self.schedule_path) or self.schedule is None:
+            self.schedule = Schedule(self.schedule_path)
+
+        for tag in scheduler.failed:
+            self.failed[tag] = time.monotonic()
+            self.clean = False
+        del scheduler.failed[:]
+        now = time.monotonic()
+        for tag, priority, lateness in due_tags(self.tags, self.schedule, self.updated, 0):
+            if scheduler.pending(tag) or now - self.failed.get(tag, -math.inf) < retry_failed * 60:
+                continue
+            self.failed.pop(tag, None)
+            scheduler.add(tag, priority, lateness)
+            self.busy = True
+
+        # publish mirrorlists for new repos soon after they are published
+        finished = self.updated.count
+        if finished != self.published:
+            self.published = finished
+            for timer in self.changed:
+                timer.soon(changed_delay)
+        # the timer due longest goes first, so none of a script's timers starve
+        busy = set(timer.command[0] for timer in self.timers if timer.running)
+        for timer in sorted(self.timers, key=lambda timer: timer.next):
+            if timer.poll(busy):
+                busy.add(timer.command[0])
+
+        if self.busy and not scheduler.queue and not scheduler.running:
+            self.busy = False
+            if self.clean:
+                self.cycle_done()
+            self.clean = True
+
+    def refresh(self, tag):
+        """Queue tag ahead of everything not already forced, and return its
+        status, or None for a tag not in the tag list. A tag that is running
+        is queued again, since the run may have missed what it was forced
+        for."""
+        if tag not in self.tags:
+            return None
+        scheduler = self.scheduler
+        for job in scheduler.queue:
+            if job.tag == tag:
+                break
+        else:
+            scheduler.add(tag, forced, math.inf)
+            job = scheduler.queue[-1]
+            self.busy = True
+        log("%s forced through the control API" % tag)
+        job.priority = forced
+        job.requested = time.time()
+        return self.status(tag)
+
+    def status(self, tag):
+        """Return the state of tag: queued with its position in the queue,
+        running, or the exit status and time of its last run"""
+        scheduler = self.scheduler
+        status = {"tag": tag, "updated": self.updated.tags.get(tag)}
+        order = scheduler.order()
+        for position, job in enumerate(order, 1):
+            if job.tag == tag:
+                status.update(state="queued", position=position, of=len(order),
+                              requested=getattr(job, "requested", None))
+                return status
+        job = scheduler.running.get(tag)
+        if job:
+            status.update(state="running", started=job.started_at, attempt=job.attempts)
+        elif tag in scheduler.results:
+            code, finished = scheduler.results[tag]
+            status.update(state="failed" if code else "updated", exit=code, finished=finished)
+        else:
+            status.update(state="idle")
+        return status
+
+    def cycle_done(self):
+        log("all due tags updated")
+        osgdir = os.path.join(self.repodir, "osg")
+        # SOFTWARE-4420, SOFTWARE-4689: temporary upcoming symlink to 3.5-upcoming
+        uplink = os.path.join(osgdir, "upcoming")
+        if not os.path.islink(uplink):
+            os.symlink("3.5-upcoming", uplink)
+        # Update timestamp showing last successful run
+        with open(os.path.join(osgdir, "timestamp.txt"), "w") as f:
+            f.write(time.strftime("%a %b %d %H:%M:%S %Z %Y\n"))
+        subprocess.call([os.path.join(bindir, "update_manifest.py"), "--all", "--prune",
+                         "--tags-file", self.tags_path])
+
+    def stop(self, signum, frame):
+        # unwind first: the signal may have come while this thread held
+        # the log lock or the stdout buffer, which the cleanup needs
+        raise Stopped(signum)
+
+    def run(self, port):
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        try:
+            self.serve(port)
+        except Stopped as e:
+            log("exiting on signal %d" % e.args[0])
+            sys.exit(0)
+        finally:
+            # jobs run in sessions of their own, out of reach of
+            # supervisord, and would keep holding their group locks
+            self.scheduler.kill()
+            for timer in self.timers:
+                timer.kill()
+
+    def serve(self, port):
+        if port:
+            server = ControlServer(("127.0.0.1", port), ControlHandler)
+            server.daemon = self
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            log("control API on 127.0.0.1:%d" % port)
+        self.scheduler.run(self.refill)
+
+class ControlHandler(http.server.BaseHTTPRequestHandler):
+    """The daemon's control API:
+
+    GET /queue          the queued and running tags, in order
+    GET /tags/TAG       the status of TAG
+    POST /tags/TAG      update TAG ahead of the schedule, returning its status
+    """
+    server_version = "repo_scheduler"
+
+    def send(self, code, data):
+        body = (json.dumps(data, indent=1, sort_keys=True) + "\n").encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        daemon = self.server.daemon
+        parts = [p for p in self.path.split("?", 1)[0].split("/") if p]
+        with daemon.scheduler.lock:
+            if parts == ["queue"]:
+                scheduler = daemon.scheduler
+                self.send(200, {"running": sorted(scheduler.running),
+                                "queued": [job.tag for job in scheduler.order()]})
+            elif len(parts) == 2 and parts[0] == "tags" and parts[1] in daemon.tags:
+                self.send(200, daemon.status(parts[1]))
+            else:
+                self.send(404, {"error": "not found"})
+
+    def do_POST(self):
+        daemon = self.server.daemon
+        parts = [p for p in self.path.split("?", 1)[0].split("/") if p]
+        status = None
+        with daemon.scheduler.lock:
+            if len(parts) == 2 and parts[0] == "tags":
+                status = daemon.refresh(parts[1])
+        if status is None:
+            self.send(404, {"error": "unknown tag"})
+        else:
+            self.send(202, status)
+
+    def log_message(self, format, *args):
+        pass
+
+class ControlServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+def describe(status):
+    state = status["state"]
+    if state == "queued":
+        return "queued at position %d of %d" % (status["position"], status["of"])
+    if state == "running":
+        return "running since " + time.ctime(status["started"])
+    if state == "idle":
+        return "not run since the daemon started"
+    return "%s at %s (exit status %d)" % (state, time.ctime(status["finished"]), status["exit"])
+
+def refresh(tags, port, wait):
+    """Force tags through the daemon's control API; with wait, follow them
+    until they are updated. Return whether all were queued (and updated)."""
+    def call(method, tag):
+        url = "http://127.0.0.1:%d/tags/%s" % (port, urllib.request.quote(tag))
+        request = urllib.request.Request(url, data=b"" if method == "POST" else None,
+                                         method=method)
+        with urllib.request.urlopen(request, timeout=30) as response:
+            return json.loads(response.read().decode())
+
+    ok = True
+    requested = {}
+    for tag in tags:
+        try:
+            status = call("POST", tag)
+        except urllib.error.HTTPError as e:
+            log("cannot refresh %s: %s" % (tag, "not in the tag list" if e.code == 404 else e))
+            ok = False
+            continue
+        except urllib.error.URLError as e:
+            log("cannot reach repo_scheduler.py --daemon on port %d: %s" % (port, e.reason))
+            return False
+        log("%s %s" % (tag, describe(status)))
+        requested[tag] = (status["requested"], describe(status))
+    while wait and requested:
+        time.sleep(poll)
+        for tag, (when, last) in list(requested.items()):
+            try:
+                status = call("GET", tag)
+            except (urllib.error.URLError, IOError) as e:
+                log("lost the daemon: %s" % e)
+                return False
+            if status["state"] in ("updated", "failed") and status["finished"] >= when:
+                del requested[tag]
+                ok = ok and status["state"] == "updated"
+            if describe(status) != last:
+                log("%s %s" % (tag, describe(status)))
+                if tag in requested:
+                    requested[tag] = (when, describe(status))
+    return ok
+
+def main():
+    args = parse_args()
+
+    if args.refresh:
+        sys.exit(0 if refresh(args.refresh, args.control_port, args.wait) else 1)
+
+    make_state_dir(args.state_dir)
+    durations = Durations(os.path.join(args.state_dir, "tag-durations.json"))
+    updated = Updated(os.path.join(args.state_dir, "tag-updated.json"))
+    schedule = Schedule(args.schedule)
+    admission = Admission(args.max_load, args.max_pressure, int(args.mem_reserve * 2**20))
+    peaks = PeakRSS(os.path.join(args.state_dir, "tag-rss.json"), default_rss * 2**20)
+    scheduler = Scheduler(args.update_repo, args.jobs, args.retries, durations, updated,
+                          admission, peaks, args.timeout * 60)
+
+    if args.daemon:
+        # don't overlap with update_all_repos.sh
+        if not os.path.isdir(lockdir):
+            os.makedirs(lockdir)
+        lk = open(os.path.join(lockdir, "all-repos.lk"), "w")
+        fcntl.flock(lk, fcntl.LOCK_EX)
+        log("running as a daemon with up to %d workers" % args.jobs)
+        Daemon(scheduler, args.schedule, args.tags_file, updated, args.repo_dir).run(
+            args.control_port)
+        return
+
+    tags = args.tags or read_tags(args.tags_file)
+    lookahead = math.inf if (args.all or args.tags) else args.interval * 60
+    queued = []
+    for tag, priority, lateness in due_tags(tags, schedule, updated, lookahead):
+        scheduler.add(tag, priority, lateness)
+        queued.append(tag)
+    if len(queued) < len(tags):
+        log("skipping %d tags that are fresh enough until the next run"
+            % (len(tags) - len(queued)))
+    log("Updating %d tags with %d workers, about %d seconds of work"
+        % (len(queued), args.jobs, sum(durations.predict(tag) for tag in queued)))
+    ok = scheduler.run()
+    if not ok:
+        log("failed tags: "+" ".join(scheduler.failed))
+    sys.exit(0 if ok else 1)
+
+if __name__ == "__main__":
+    main()
@@ -2,9 +2,10 @@
 set -e
 
 usage () {
-  echo "Usage: $(basename "$0") [-L LOGDIR] [-K LOCKDIR]"
+  echo "Usage: $(basename "$0") [-L LOGDIR] [-K LOCKDIR] [-j JOBS]"
   echo "Runs update_repo.sh on all tags in $OSGTAGS"
   echo "Logs are written to LOGDIR, /var/log/repo by default"
+  echo "Up to JOBS tags (1 by default) are updated at once, one per SERIES.DVER"
   exit
 }
 
@@ -12,20 +13,18 @@ datemsg () {
   echo "$(date):" "$@"
 }
 
-prepend_tag() {
-  while read line; do echo "${1}${line}"; done;
-}
-
 # cd /usr/local
 cd "$(dirname "$0")"
 LOGDIR=/var/log/repo
 LOCKDIR=/var/lock/repo
 OSGTAGS=/etc/osg-koji-tags/osg-tags
+JOBS=1
 
 while [[ $1 = -* ]]; do
 case $1 in
   -L ) LOGDIR=$2; shift 2 ;;
   -K ) LOCKDIR=$2; shift 2 ;;
+  -j ) JOBS=$2; shift 2 ;;
   --help | -* ) usage ;;
 esac
 done
@@ -47,14 +46,16 @@ fi
 
 failed=0
 datemsg "Updating all mash repos..."
-for tag in $(tac $OSGTAGS); do
-  datemsg "Running update_repo.sh for tag $tag ..."
-  if ! ./update_repo.sh "$tag" 2>&1 | prepend_tag "[update_repo.sh $tag] "; then
-    datemsg "mash failed for $tag - please see error log" >&2
-    failed=1
-  fi
-done
+if ! ./repo_scheduler.py -j "$JOBS" --tags-file "$OSGTAGS"; then
+  failed=1
+fi
 datemsg "Finished updating all mash repos."
+
+# Add repos never republished (create-only tags) to the manifest, and
+# drop repos that are no longer published
+if ! ./update_manifest.py --all --prune --tags-file "$OSGTAGS"; then
+  datemsg "Failed to update the repo manifest" >&2
+fi
 echo
 
 # SOFTWARE-4420, SOFTWARE-4689: temporary upcoming symlink to 3.5-upcoming
@@ -0,0 +1,107 @@
+#!/usr/bin/python3
+"""Maintain osg/manifest.json, the list of every published repo.
+
+update_repo.sh runs this with the tag it just published, to replace the
+entries of that tag's arches; update_all_repos.sh runs it with --all
+--prune to add tags that are never republished (create-only tags) and
+drop repos that are no longer published. The first run always scans all
+tags, so no mirror ever syncs a manifest missing published repos. The manifest is synced to the
+mirrors with the rest of the tree, so update_mirror.py can judge all the
+repos of a mirror from one request.
+"""
+
+import argparse
+import fcntl
+import os
+import sys
+import time
+
+from update_mirror import log, load_state, save_state, tagsplit, read_repomd, manifest
+
+repodir = "/usr/local/repo"
+tagsfile = "/etc/osg-koji-tags/osg-tags"
+lockfile = "/var/lock/repo/manifest.lk"
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Update the repo manifest that mirrors are judged by")
+    parser.add_argument("tags", nargs="*", metavar="TAG",
+        help="koji tag whose repos were just published")
+    parser.add_argument("--all", action="store_true",
+        help="update every tag in --tags-file")
+    parser.add_argument("--tags-file", default=tagsfile, metavar="FILE",
+        help="tags for --all (default: %(default)s)")
+    parser.add_argument("--prune", action="store_true",
+        help="drop repos whose repomd.xml no longer exists")
+    parser.add_argument("--repo-dir", default=repodir, metavar="DIR",
+        help="local repo tree (default: %(default)s)")
+    parser.add_argument("--lock-file", default=lockfile, metavar="FILE",
+        help="lock serializing updates (default: %(default)s)")
+    args = parser.parse_args()
+    if not args.tags and not args.all and not args.prune:
+        parser.error("nothing to do")
+    return args
+
+def entry(mdpath):
+    """Return the manifest entry of a repomd.xml"""
+    info = read_repomd(mdpath)
+    return dict((name, info[name]) for name in
+                ("revision", "primary", "timestamp", "published", "size", "sha256")
+                if name in info)
+
+def update_tag(repos, osgdir, tag):
+    series,dver,repo = tagsplit(tag)
+    path = os.path.join(osgdir, series, dver, repo)
+    prefix = '/'.join([series,dver,repo]) + "/"
+    for key in [key for key in repos if key.startswith(prefix)]:
+        del repos[key]
+    try:
+        archs = os.listdir(path)
+    except OSError:
+        archs = []
+    for arch in sorted(archs):
+        mdpath = os.path.join(path, arch, "repodata", "repomd.xml")
+        if os.path.exists(mdpath):
+            repos[prefix + arch] = entry(mdpath)
+
+def read_tags(path):
+    with open(path) as f:
+        return sorted(set(line.rstrip("\n").split(":")[0] for line in f if line.strip()))
+
+def prune(repos, osgdir):
+    for key in list(repos):
+        if not os.path.exists(os.path.join(osgdir, key, "repodata", "repomd.xml")):
+            log("dropping "+key+" from the manifest")
+            del repos[key]
+
+def main():
+    args = parse_args()
+    osgdir = os.path.join(args.repo_dir, "osg")
+    path = os.path.join(osgdir, manifest)
+
+    dir = os.path.dirname(args.lock_file)
+    if dir and not os.path.exists(dir):
+        os.makedirs(dir)
+    with open(args.lock_file, "w") as lk:
+        fcntl.flock(lk, fcntl.LOCK_EX)
+        tags = args.tags
+        if args.all or not os.path.exists(path):
+            if not args.all:
+                log("no manifest yet, adding all tags")
+            try:
+                tags = sorted(set(tags) | set(read_tags(args.tags_file)))
+            except IOError as e:
+                log("cannot read tags: "+str(e))
+                sys.exit(1)
+        repos = load_state(path, {}).get("repos", {})
+        for tag in tags:
+            try:
+                update_tag(repos, osgdir, tag)
+            except ValueError:
+                log("skipping malformed tag "+tag)
+        if args.prune:
+            prune(repos, osgdir)
+        save_state(path, {"version": 1, "generated": time.time(), "repos": repos})
+
+if __name__ == "__main__":
+    main()
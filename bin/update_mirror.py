@@ -1,39 +1,63 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
-from __future__ import print_function
-import urllib2
-import time
-import sys
+import argparse
+import bz2
+import concurrent.futures
+import csv
+import errno
+import fcntl
+import gzip
+import hashlib
+import http.client
+import io
+import json
+import lzma
+import math
 import os
+import random
+import re
 import shutil
 import socket
-import fcntl
-import errno
-import re
+import sqlite3
+import statistics
+import sys
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+_log_lock = threading.Lock()
 
 def log(log):
-    print("[%s]"%sys.argv[0], time.strftime("%a %m/%d/%y %H:%M:%S %Z: ", time.localtime()), log)
+    with _log_lock:
+        print("[%s]"%sys.argv[0], time.strftime("%a %m/%d/%y %H:%M:%S %Z: ", time.localtime()), log)
+        sys.stdout.flush()
+
+def make_state_dir(path):
+    """Create the state directory; it may be a symlink to a directory on a
+    data volume that does not exist yet (/var/lib/repo in the image)"""
+    os.makedirs(os.path.realpath(path), exist_ok=True)
 
-def lock(path):
+def lock(path, wait=0):
+    """Take the lock at path, waiting up to `wait` seconds for another run
+    to release it; return whether it was taken"""
     dir = os.path.dirname(path)
     if dir and not os.path.exists(dir):
         os.makedirs(dir)
     lock_fd = os.open(path, os.O_WRONLY | os.O_CREAT)
-    try:
-        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
-    except IOError, e:
-        if e.errno == errno.EWOULDBLOCK:
-            log("Script appears to already be running.")
-            sys.exit(1)
-
-lock("/var/lock/repo/update-mirror.lk")
-
-tagfile = open("/etc/osg-koji-tags/osg-tags", "r")
-tags = [tag.rstrip("\n").split(":")[0] for tag in tagfile]
-tags = sorted(set(tags))
-tagfile.close()
+    give_up = time.monotonic() + wait
+    while True:
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except IOError as e:
+            if e.errno != errno.EWOULDBLOCK:
+                raise
+        if time.monotonic() >= give_up:
+            return False
+        time.sleep(1)
 
-archs = ["i386", "x86_64"]
 mirrorhosts = [
     # list of mirror base urls, where osg/series/dver/repo/arch can be found
     "http://mirror.hep.wisc.edu/upstream",
@@ -41,22 +65,154 @@ mirrorhosts = [
     "http://mirror.grid.uchicago.edu/pub"
 ]
 
-threshold = 24 #hours
+origins = {
+    # origin service: base urls of the replicas serving the same tree; the
+    # replicas are probed like mirrors and the fresh ones listed first
+    "repo.opensciencegrid.org": ["http://repo.opensciencegrid.org"],
+    "repo-itb.opensciencegrid.org": ["http://repo-itb.opensciencegrid.org"],
+}
+
+# relative share of client load each host should take, scaled down for
+# hosts measured to be slower than the fastest; mirrors not listed get 1,
+# origin replicas not listed get origin_weight
+origin_weight = 1
+capacity = {
+    "http://mirror.hep.wisc.edu/upstream": 1,
+    "http://t2.unl.edu": 1,
+    "http://mirror.grid.uchicago.edu/pub": 1,
+}
+
+tagsfile = "/etc/osg-koji-tags/osg-tags"
+lockfile = "/var/lock/repo/update-mirror.lk"
+repodir = "/usr/local/repo"
+mirrordir = "/usr/local/mirror"
+statedir = "/var/lib/repo"
+
+revisions = 3 #recent local repomd revisions a mirror may serve
+threshold = 24 #hours, for repos with no local repomd to compare against
+recheck = 24 #hours between probes of series/dvers a host does not carry
 timeout = 10 #seconds
-socket.setdefaulttimeout(timeout)
+per_host = 4 #concurrent requests per mirror host
+deadline = 600 #seconds for the whole probe run
+lock_wait = 900 #seconds a full sweep waits for a run in progress to finish
+calibrate_size = 256 * 1024 #bytes, target size of the transfer rate test
+hashes = ("md5", "sha1", "sha256", "sha512") #of repomd.xml, for metalinks
+manifest = "manifest.json" #under osg/, written by update_manifest.py
+journal = "published-tags" #in the state dir, appended to by update_repo.sh
+sample = 3 #packages checked per sampled repo on a mirror
+sample_budget = 0 #package HEAD requests per run; 0 disables sampling
+reshuffle = 6 #hours an unchanged mirrorlist keeps its weighted order
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Probe the OSG mirrors and regenerate the yum mirrorlists")
+    parser.add_argument("--per-host", type=int, default=per_host, metavar="N",
+        help="max in-flight requests per mirror host (default: %(default)s)")
+    parser.add_argument("--deadline", type=float, default=deadline, metavar="SECS",
+        help="wall clock budget for probing all mirrors; probes not finished "
+             "by then count as failed (default: %(default)s)")
+    parser.add_argument("--timeout", type=float, default=timeout, metavar="SECS",
+        help="timeout for a single request (default: %(default)s)")
+    parser.add_argument("--calibrate-size", type=int, default=calibrate_size,
+        metavar="BYTES",
+        help="measure each mirror's transfer rate by fetching the primary "
+             "metadata closest to this size; 0 orders mirrors by RTT only "
+             "(default: %(default)s)")
+    parser.add_argument("--order", choices=["weighted", "ranked"], default="weighted",
+        help="weighted: shuffle each mirrorlist so every host comes first in "
+             "proportion to its weight; ranked: origin first, then mirrors "
+             "fastest first (default: %(default)s)")
+    parser.add_argument("--weight", action="append", default=[],
+        metavar="HOST=WEIGHT",
+        help="override the capacity weight of a mirror base url, or of the "
+             "origin replicas with origin=WEIGHT; may be repeated")
+    parser.add_argument("--sample", type=int, default=sample, metavar="N",
+        help="packages to HEAD in each sampled repo on a mirror "
+             "(default: %(default)s)")
+    parser.add_argument("--sample-budget", type=int, default=sample_budget,
+        metavar="N",
+        help="package HEAD requests per run; repos that failed before are "
+             "sampled first, then random fresh repos; 0 disables sampling "
+             "(default: %(default)s)")
+    parser.add_argument("--revisions", type=int, default=revisions, metavar="N",
+        help="accept mirrors serving one of the last N repomd revisions "
+             "published here (default: %(default)s)")
+    parser.add_argument("--recheck", type=float, default=recheck, metavar="HOURS",
+        help="how often to look for series/dvers a mirror has never served "
+             "(default: %(default)s)")
+    parser.add_argument("--origin", action="append", dest="origins", metavar="URL",
+        help="origin replica base url, instead of the replicas of the "
+             "origin this host belongs to; may be repeated")
+    parser.add_argument("--host", action="append", dest="hosts", metavar="URL",
+        help="probe this mirror base url instead of the built-in list; "
+             "may be repeated")
+    parser.add_argument("--tags-file", default=tagsfile, metavar="FILE",
+        help="koji tags to publish mirrorlists for (default: %(default)s)")
+    parser.add_argument("--lock-file", default=lockfile, metavar="FILE",
+        help="lock held while running (default: %(default)s)")
+    parser.add_argument("--repo-dir", default=repodir, metavar="DIR",
+        help="local repo tree, used to decide which arches to probe "
+             "(default: %(default)s)")
+    parser.add_argument("--changed", action="store_true",
+        help="only probe the repos update_repo.sh published since the last "
+             "run, and keep the mirrorlists of the others")
+    parser.add_argument("--report", action="store_true",
+        help="print per-mirror lag and latency percentiles from the probe "
+             "history instead of probing")
+    parser.add_argument("--since", type=float, default=7, metavar="DAYS",
+        help="history window for --report (default: %(default)s)")
+    parser.add_argument("--format", choices=["text", "csv", "json"], default="text",
+        help="output format for --report (default: %(default)s)")
+    parser.add_argument("--mirror-dir", default=mirrordir, metavar="DIR",
+        help="where the mirrorlist tree is published (default: %(default)s)")
+    parser.add_argument("--state-dir", default=statedir, metavar="DIR",
+        help="where probe state is kept between runs (default: %(default)s)")
+    return parser.parse_args()
 
-log("Using following parameters")
-log("tags:"+str(tags))
-log("hosts:"+str(mirrorhosts))
-log("archs:"+str(archs))
-log("threshold:"+str(threshold)+" (hours)")
-log("timeout:"+str(timeout)+" (seconds)")
-print
+def origin_replicas():
+    """Return the replicas of the origin service this host is part of"""
+    #gethostname() returns actual instance name (like repo2.opensciencegrid.org)
+    name = socket.gethostname()
+    for service, replicas in sorted(origins.items()):
+        if name == service or name in [urllib.parse.urlsplit(url).hostname
+                                       for url in replicas]:
+            return replicas
+    return origins["repo.opensciencegrid.org"]
 
-#gethostname() returns actual instance name (like repo2.opensciencegrid.org)
-hostname="repo.opensciencegrid.org"
-if socket.gethostname() == "repo-itb.opensciencegrid.org":
-    hostname="repo-itb.opensciencegrid.org"
+def parse_weights(args):
+    weights = dict(capacity, origin=origin_weight)
+    for arg in args.weight:
+        host, _, weight = arg.rpartition("=")
+        try:
+            weights[host] = float(weight)
+        except ValueError:
+            sys.exit("bad --weight "+arg)
+    return weights
+
+def weighted_order(entries, rng=random):
+    """Shuffle (item, weight) pairs so that each item comes first with a
+    probability proportional to its weight (Efraimidis-Spirakis); items
+    with no weight go last, in order"""
+    keyed = [(rng.random() ** (1.0 / weight), item)
+             for item, weight in entries if weight > 0]
+    keyed.sort(key=lambda k: k[0], reverse=True)
+    return [item for key, item in keyed] + [item for item, weight in entries if weight <= 0]
+
+def load_state(path, default):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return default
+    except (IOError, ValueError) as e:
+        log("ignoring unreadable state file "+path+": "+str(e))
+        return default
+
+def save_state(path, data):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, indent=1, sort_keys=True)
+    os.replace(tmp, path)
 
 def tagsplit(tag):
     if re.match(r'osg-[0-9.]*-[a-z]*-el[0-9]+-[a-z]*', tag):
@@ -75,72 +231,1287 @@ def mkarchurl(host,tag,arch):
     series,dver,repo = tagsplit(tag)
     return '/'.join([host,'osg',series,dver,repo,arch])
 
-def test(hosts,tag,arch):
-    # always include repo.opensciencegrid.org in list
-    list = [mkarchurl('http://'+hostname,tag,arch)]
-    for host in hosts:
+def repo_archs(repodir, tag):
+    """Return the arches published for tag in the local repo tree.
+
+    Tags that have not been published yet fall back to the same ARCHES
+    logic as new_mashfile.sh.
+    """
+    series,dver,repo = tagsplit(tag)
+    path = os.path.join(repodir,'osg',series,dver,repo)
+    try:
+        archs = sorted(arch for arch in os.listdir(path)
+                       if os.path.exists(os.path.join(path,arch,"repodata","repomd.xml")))
+    except OSError:
+        archs = []
+    if archs:
+        return archs
+    if dver in ("el5", "el6"):
+        return ["i386", "x86_64"]
+    return ["x86_64"]
+
+def parse_repomd(stream, chunksize=1024):
+    """Return the revision and primary checksum from a repomd.xml stream.
+
+    Parsing stops as soon as both have been seen, which is usually within
+    the first chunk.
+    """
+    parser = ET.XMLPullParser(events=("start", "end"))
+    info = {"revision": None, "primary": None}
+    datatype = None
+    while True:
+        chunk = stream.read(chunksize)
+        if chunk:
+            parser.feed(chunk)
+        for event, elem in parser.read_events():
+            name = elem.tag.rsplit("}", 1)[-1]
+            if event == "start":
+                if name == "data":
+                    datatype = elem.get("type")
+            elif name == "revision":
+                info["revision"] = (elem.text or "").strip()
+            elif name == "checksum" and datatype == "primary":
+                info["primary"] = (elem.text or "").strip()
+            elif name == "location" and datatype == "primary":
+                info["primary_href"] = elem.get("href")
+            elif name == "size" and datatype == "primary":
+                info["primary_size"] = int(elem.text)
+            elif name == "timestamp" and datatype:
+                info["timestamp"] = max(info.get("timestamp", 0), int(float(elem.text)))
+            elif name == "data":
+                datatype = None
+        if not chunk or (info["revision"] and info["primary"]):
+            return info
+
+def read_repomd(path):
+    """Return the parse_repomd() info of a local repomd.xml, with its
+    publish time (mtime), size and hashes"""
+    with open(path, "rb") as f:
+        data = f.read()
+        info = parse_repomd(io.BytesIO(data), chunksize=len(data) + 1)
+        info["published"] = os.fstat(f.fileno()).st_mtime
+    info["size"] = len(data)
+    for name in hashes:
+        info[name] = hashlib.new(name, data).hexdigest()
+    return info
+
+def read_packages(path):
+    """Return the package locations listed in a local primary metadata file"""
+    opener = {".gz": gzip.open, ".bz2": bz2.open, ".xz": lzma.open}.get(
+        os.path.splitext(path)[1], open)
+    hrefs = []
+    with opener(path, "rb") as f:
+        for event, elem in ET.iterparse(f):
+            name = elem.tag.rsplit("}", 1)[-1]
+            if name == "location" and elem.get("href"):
+                hrefs.append(elem.get("href"))
+            elif name == "package":
+                elem.clear()
+    return hrefs
+
+def read_journal(path):
+    """Return the tags update_repo.sh has published since the journal was
+    last read, and empty it"""
+    try:
+        f = open(path, "r+")
+    except FileNotFoundError:
+        return set()
+    with f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        lines = f.read().splitlines()
+        f.truncate(0)
+    return set(line.split()[-1] for line in lines if line.strip())
+
+def read_json(stream):
+    return json.loads(stream.read().decode("utf-8"))
+
+def check_manifest(repos):
+    """Raise ValueError unless repos is a manifest's map of repo keys to
+    entries with a revision, a primary and a publish time"""
+    if not isinstance(repos, dict):
+        raise ValueError("repos is not an object")
+    for key, meta in repos.items():
+        if not (isinstance(meta, dict) and meta.get("revision") is not None
+                and meta.get("primary") is not None
+                and isinstance(meta.get("published"), (int, float))
+                and not isinstance(meta.get("published"), bool)):
+            raise ValueError("bad entry for "+str(key))
+
+def outcome(fut, what):
+    """Return the result of a finished future, or None if it raised"""
+    try:
+        return fut.result()
+    except Exception as e:
+        log("error in "+what+": "+repr(e))
+        return None
+
+def count_bytes(stream, chunksize=65536):
+    """Read stream to the end and return its length"""
+    length = 0
+    while True:
+        chunk = stream.read(chunksize)
+        if not chunk:
+            return length
+        length += len(chunk)
+
+class HTTPPool(object):
+    """Keep-alive HTTP(S) connections, reused for every request to a host.
+
+    Connections are checked out for the duration of one request, so each
+    host never has more open connections than concurrent requests.
+    """
+
+    redirects = (301, 302, 303, 307, 308)
+    drain = 65536 #max unread body bytes to discard to keep a connection
+
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self.idle = {}
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.connections = 0
+
+    def _checkout(self, key, timeout):
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns:
+                conn = conns.pop()
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                return conn, True
+            self.connections += 1
+        scheme, netloc = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(netloc, timeout=timeout), False
+        return http.client.HTTPConnection(netloc, timeout=timeout), False
+
+    def _checkin(self, key, conn):
+        with self.lock:
+            self.idle.setdefault(key, []).append(conn)
+
+    def _request(self, method, url, headers, timeout, reader):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or "/"
+        if parts.query:
+            path += "?" + parts.query
+        conn, reused = self._checkout(key, timeout)
+        try:
+            with self.lock:
+                self.requests += 1
+            conn.request(method, path, headers=headers)
+            response = conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionResetError,
+                BrokenPipeError):
+            conn.close()
+            if not reused:
+                raise
+            # the server dropped an idle keep-alive connection; retry once
+            return self._request(method, url, headers, timeout, reader)
+        except:
+            conn.close()
+            raise
+        try:
+            response.parsed = None
+            if reader and response.status == 200:
+                response.parsed = reader(response)
+            if response.length is None or response.length <= self.drain:
+                response.read()
+        except:
+            conn.close()
+            raise
+        if response.will_close or not response.isclosed():
+            conn.close()
+        else:
+            self._checkin(key, conn)
+        return response
+
+    def request(self, method, url, headers={}, timeout=None, reader=None):
+        """Perform a request, following redirects, and return the response.
+
+        If reader is given it is called with a 200 response to consume as
+        much of the body as it needs, and its result is stored as
+        response.parsed. A short remainder of the body is read and discarded
+        so the connection can be reused; connection failures raise OSError.
+        """
+        if timeout is None:
+            timeout = self.timeout
+        for _ in range(5):
+            response = self._request(method, url, headers, timeout, reader)
+            location = response.getheader("Location")
+            if response.status not in self.redirects or not location:
+                break
+            url = urllib.parse.urljoin(url, location)
+        response.url = url
+        return response
+
+    def close(self):
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+class Revisions(object):
+    """The last few repomd revisions published locally for each repo.
+
+    Every run reads the local repodata/repomd.xml of each probed repo and
+    remembers its revision and primary checksum, so mirrors that are a
+    publish or two behind can still be accepted, along with the size,
+    timestamp and hashes of repomd.xml itself for the metalinks.
+    """
+
+    def __init__(self, path, keep):
+        self.path = path
+        self.keep = keep
+        self.repos = load_state(path, {})
+
+    def key(self, tag, arch):
+        series,dver,repo = tagsplit(tag)
+        return '/'.join([series,dver,repo,arch])
+
+    def update(self, repodir, matrix, prune=True):
+        """Record the local revision of each tag/arch in matrix. With prune,
+        repos not in matrix are forgotten."""
+        repos = {} if prune else self.repos
+        for tag, arch in matrix:
+            key = self.key(tag, arch)
+            history = self.repos.get(key, [])
+            mdpath = os.path.join(repodir,'osg',key,"repodata","repomd.xml")
+            try:
+                info = read_repomd(mdpath)
+            except FileNotFoundError:
+                info = None
+            except Exception as e:
+                log("cannot read local "+mdpath+": "+str(e))
+                info = None
+            if info and info["revision"] and info["primary"]:
+                if history and (history[0]["revision"], history[0]["primary"]) \
+                        == (info["revision"], info["primary"]):
+                    history[0] = info
+                else:
+                    history.insert(0, info)
+            if history:
+                repos[key] = history[:self.keep]
+        self.repos = repos
+
+    def get(self, tag, arch):
+        """Return the known revisions of tag/arch, newest first"""
+        return self.repos.get(self.key(tag, arch), [])
+
+    def save(self):
+        save_state(self.path, self.repos)
+
+def metalink(history, urls):
+    """Return a yum/dnf metalink for repomd.xml.
+
+    history is the list of local revisions, newest first; the older ones
+    are listed as alternates so clients accept mirrors that are a publish
+    or two behind. urls are the repo urls in order of preference.
+    """
+    # revisions recorded before their hashes were kept can't be described
+    history = [rev for rev in history if "sha256" in rev]
+    def describe(rev, indent):
+        lines = ["<mm0:timestamp>%d</mm0:timestamp>" % rev.get("timestamp", rev["published"]),
+                 "<size>%d</size>" % rev["size"],
+                 "<verification>"]
+        lines += [' <hash type="%s">%s</hash>' % (name, rev[name])
+                  for name in hashes]
+        lines += ["</verification>"]
+        return "".join(indent + line + "\n" for line in lines)
+
+    out = ['<?xml version="1.0" encoding="utf-8"?>\n',
+           '<metalink version="3.0" xmlns="http://www.metalinker.org/" type="dynamic"'
+           ' pubdate="%s" generator="update_mirror.py"'
+           ' xmlns:mm0="http://fedorahosted.org/mirrormanager">\n'
+           % time.strftime("%a, %d %b %Y %H:%M:%S GMT", time.gmtime(history[0]["published"])),
+           ' <files>\n',
+           '  <file name="repomd.xml">\n',
+           describe(history[0], "   ")]
+    if len(history) > 1:
+        out.append("   <mm0:alternates>\n")
+        for rev in history[1:]:
+            out += ["    <mm0:alternate>\n", describe(rev, "     "),
+                    "    </mm0:alternate>\n"]
+        out.append("   </mm0:alternates>\n")
+    out.append('   <resources maxconnections="1">\n')
+    for i, url in enumerate(urls):
+        scheme = urllib.parse.urlsplit(url).scheme
+        out.append('    <url protocol="%s" type="%s" preference="%d">%s</url>\n'
+                   % (scheme, scheme, max(100 - i, 1), escape(url + "/repodata/repomd.xml")))
+    out += ["   </resources>\n", "  </file>\n", " </files>\n", "</metalink>\n"]
+    return "".join(out)
+
+class Generation(object):
+    """A new mirrorlist tree, built beside the live one.
+
+    Files are written to a fresh .osg.<timestamp> directory while the live
+    tree keeps being served; files whose content is unchanged are
+    hardlinked from the live tree instead of rewritten. commit() points
+    the live symlink at the new tree with a single rename, then removes
+    all generations but the new and the previous one.
+    """
+
+    def __init__(self, mirrordir, name="osg"):
+        self.mirrordir = mirrordir
+        self.name = name
+        self.link = os.path.join(mirrordir, name)
+        self.live = None
+        if os.path.isdir(self.link):
+            self.live = os.path.realpath(self.link)
+        stamp = time.strftime("%Y%m%d%H%M%S")
+        dirname = ".%s.%s" % (name, stamp)
+        n = 0
+        while os.path.lexists(os.path.join(mirrordir, dirname)):
+            n += 1
+            dirname = ".%s.%s.%d" % (name, stamp, n)
+        self.path = os.path.join(mirrordir, dirname)
+        os.makedirs(self.path)
+        self.written = 0
+        self.linked = 0
+
+    def write(self, relpath, content):
+        path = os.path.join(self.path, relpath)
+        dir = os.path.dirname(path)
+        if not os.path.isdir(dir):
+            os.makedirs(dir)
+        content = content.encode()
+        if self.live:
+            old = os.path.join(self.live, relpath)
+            try:
+                if os.path.getsize(old) == len(content):
+                    with open(old, "rb") as f:
+                        same = f.read() == content
+                    if same:
+                        os.link(old, path)
+                        self.linked += 1
+                        return
+            except OSError:
+                pass
+        with open(path, "wb") as f:
+            f.write(content)
+        self.written += 1
+
+    def symlink(self, target, relpath):
+        os.symlink(target, os.path.join(self.path, relpath))
+
+    def commit(self):
+        tmp = self.link + ".tmp"
+        if os.path.lexists(tmp):
+            os.unlink(tmp)
+        os.symlink(os.path.basename(self.path), tmp)
+        os.rename(tmp, self.link)
+        log("published %s: %d files written, %d unchanged"
+            % (self.path, self.written, self.linked))
+
+        keep = set([os.path.basename(self.path)])
+        if self.live:
+            keep.add(os.path.basename(self.live))
+        for entry in os.listdir(self.mirrordir):
+            path = os.path.join(self.mirrordir, entry)
+            if entry.startswith("."+self.name+".") and entry not in keep \
+                    and os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path)
+
+class ProbeCache(object):
+    """Validators and last verdict for each probed URL, kept across runs.
+
+    Entries not refreshed for `expire` seconds (e.g. for tags that went
+    away) are dropped when the cache is saved.
+    """
+
+    expire = 7 * 24 * 3600
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = load_state(path, {})
+        self.lock = threading.Lock()
+        self.hits = 0
+
+    def get(self, url):
+        with self.lock:
+            return self.entries.get(url)
+
+    def put(self, url, entry):
+        entry["checked"] = time.time()
+        with self.lock:
+            self.entries[url] = entry
+
+    def hit(self):
+        with self.lock:
+            self.hits += 1
+
+    def save(self):
+        cutoff = time.time() - self.expire
+        with self.lock:
+            entries = dict((url, entry) for url, entry in self.entries.items()
+                           if entry.get("checked", 0) > cutoff)
+        save_state(self.path, entries)
+
+class Samples(object):
+    """Repos whose package sample a mirror failed, kept across runs.
+
+    Failed repos are sampled again first on the next run, and the mirror
+    stays demoted for them until a sample comes back whole.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.hosts = load_state(path, {})
+        self.lock = threading.Lock()
+
+    def failed(self, host, key):
+        return key in self.hosts.get(host, {})
+
+    def update(self, host, key, whole):
+        with self.lock:
+            repos = self.hosts.setdefault(host, {})
+            if whole:
+                repos.pop(key, None)
+            else:
+                repos[key] = time.time()
+
+    def save(self):
+        with self.lock:
+            save_state(self.path, dict((host, repos) for host, repos in self.hosts.items()
+                                       if repos))
+
+class HostHealth(object):
+    """Per-host circuit breaker, kept across runs.
+
+    A host that fails to connect is opened, i.e. skipped entirely, for a
+    backoff window that doubles with each consecutive failure. Once the
+    window has passed the host is half-open: a single cheap request decides
+    whether it is closed (used again) or opened for a longer window.
+    """
+
+    backoff = 1800 #seconds
+    max_backoff = 24 * 3600
+
+    def __init__(self, path):
+        self.path = path
+        self.hosts = load_state(path, {})
+        self.lock = threading.Lock()
+
+    def state(self, host):
+        """Return closed, open or half-open, moving expired hosts to half-open"""
+        with self.lock:
+            entry = self.hosts.get(host)
+            if not entry or entry["state"] == "closed":
+                return "closed"
+            if entry["state"] == "open" and time.time() < entry["opened"] + entry["backoff"]:
+                return "open"
+            entry["state"] = "half-open"
+            return "half-open"
+
+    def trip(self, host, error):
+        with self.lock:
+            entry = self.hosts.get(host, {"state": "closed", "failures": 0})
+            if entry["state"] == "open":
+                # already tripped during this run
+                return
+            failures = entry["failures"] + 1
+            self.hosts[host] = {
+                "state": "open",
+                "failures": failures,
+                "opened": time.time(),
+                "backoff": min(self.backoff * 2 ** (failures - 1), self.max_backoff),
+                "error": error,
+            }
+
+    def reset(self, host):
+        with self.lock:
+            self.hosts[host] = {"state": "closed", "failures": 0}
+
+    def save(self):
+        with self.lock:
+            save_state(self.path, self.hosts)
+
+class Coverage(object):
+    """Which series/dvers each mirror host has served, kept across runs.
+
+    A host is always probed for series/dvers it has served within the
+    last `forget` seconds; the others are rechecked every `recheck`
+    seconds, so hot runs only probe paths that can succeed.
+    """
+
+    forget = 30 * 24 * 3600
+
+    def __init__(self, path, recheck):
+        self.path = path
+        self.recheck = recheck
+        self.hosts = load_state(path, {})
+        self.lock = threading.Lock()
+
+    def key(self, tag):
+        series,dver,repo = tagsplit(tag)
+        return series+"/"+dver
+
+    def due(self, host, tag):
+        """Return True if host should be probed for tag in this run"""
+        now = time.time()
+        with self.lock:
+            entry = self.hosts.get(host, {}).get(self.key(tag))
+        if not entry:
+            return True
+        if entry.get("served", 0) > now - self.forget:
+            return True
+        return entry.get("checked", 0) <= now - self.recheck
+
+    def update(self, host, tag, served):
+        now = time.time()
+        with self.lock:
+            entry = self.hosts.setdefault(host, {}).setdefault(self.key(tag), {})
+            entry["checked"] = now
+            if served:
+                entry["served"] = now
+
+    def save(self):
+        with self.lock:
+            save_state(self.path, self.hosts)
+
+class Performance(object):
+    """Smoothed RTT and transfer rate of each mirror host, kept across runs.
+
+    Mirrors are ordered by how long they are expected to take to serve a
+    `size` byte file: RTT plus size over transfer rate.
+    """
+
+    alpha = 0.3 #weight of the newest measurement
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        self.hosts = load_state(path, {})
+
+    def update(self, host, name, value):
+        entry = self.hosts.setdefault(host, {})
+        old = entry.get(name)
+        entry[name] = value if old is None else old + self.alpha * (value - old)
+
+    def cost(self, host, default_rate=None):
+        entry = self.hosts.get(host, {})
+        if "rtt" not in entry:
+            return None
+        rate = entry.get("rate", default_rate)
+        if self.size and rate:
+            return entry["rtt"] + self.size / rate
+        return entry["rtt"]
+
+    def speed(self, hosts):
+        """Return each host's speed relative to the fastest of hosts, in
+        (0, 1]; unmeasured hosts get 1"""
+        rates = [self.hosts[host]["rate"] for host in hosts
+                 if "rate" in self.hosts.get(host, {})]
+        default_rate = statistics.median(rates) if rates else None
+        costs = dict((host, self.cost(host, default_rate)) for host in hosts)
+        measured = [cost for cost in costs.values() if cost]
+        best = min(measured) if measured else None
+        return dict((host, best / cost if cost else 1.0) for host, cost in costs.items())
+
+    def order(self, hosts):
+        """Sort hosts fastest first; unmeasured hosts keep their order, last.
+
+        Hosts with an RTT but no transfer rate are assumed to have the
+        median rate of the others.
+        """
+        rates = [self.hosts[host]["rate"] for host in hosts
+                 if "rate" in self.hosts.get(host, {})]
+        default_rate = statistics.median(rates) if rates else None
+        def key(item):
+            index, host = item
+            cost = self.cost(host, default_rate)
+            return (cost is None, cost or 0, index)
+        return [host for index, host in sorted(enumerate(hosts), key=key)]
+
+    def save(self):
+        save_state(self.path, self.hosts)
+
+class History(object):
+    """Every probe result, in a sqlite database for lag reports.
+
+    Rows older than `keep` seconds are pruned on each run.
+    """
+
+    keep = 90 * 24 * 3600
+
+    def __init__(self, path):
+        self.db = sqlite3.connect(path)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS probes (
+                time INTEGER NOT NULL,
+                host TEXT NOT NULL,
+                repo TEXT NOT NULL,
+                status TEXT NOT NULL,
+                revision TEXT,
+                lag INTEGER,
+                lag_seconds INTEGER,
+                latency_ms INTEGER
+            )""")
+        self.db.execute("""
+            CREATE INDEX IF NOT EXISTS probes_time ON probes (time)""")
+
+    def record(self, results):
+        now = int(time.time())
+        rows = []
+        for host, tag, arch, result in results:
+            series,dver,repo = tagsplit(tag)
+            rows.append((now, host, '/'.join([series,dver,repo,arch]),
+                         result["status"], result["revision"], result["lag"],
+                         rounded(result["lag_seconds"]),
+                         rounded(result["latency"], 1000)))
+        with self.db:
+            self.db.executemany("INSERT INTO probes VALUES (?,?,?,?,?,?,?,?)", rows)
+            self.db.execute("DELETE FROM probes WHERE time < ?", (now - self.keep,))
+
+    def report(self, since):
+        """Return per-host lag and latency percentiles for probes since
+        the given time, as a list of dicts"""
+        rows = self.db.execute("""
+            SELECT host, status, lag, lag_seconds, latency_ms FROM probes
+            WHERE time >= ? ORDER BY host""", (since,))
+        hosts = {}
+        for host, status, lag, lag_seconds, latency_ms in rows:
+            h = hosts.setdefault(host, {"probes": 0, "good": 0, "stale": 0,
+                                        "lag": [], "lag_seconds": [], "latency_ms": []})
+            h["probes"] += 1
+            if status in ("good", "stale"):
+                h[status] += 1
+                h["lag"].append(lag)
+                h["lag_seconds"].append(lag_seconds)
+            if latency_ms is not None:
+                h["latency_ms"].append(latency_ms)
+        report = []
+        for host in sorted(hosts):
+            h = hosts[host]
+            row = {"host": host, "probes": h["probes"], "good": h["good"],
+                   "stale": h["stale"]}
+            for name in ("lag", "lag_seconds", "latency_ms"):
+                values = sorted(h[name])
+                for p in (50, 90, 99):
+                    row["%s_p%d" % (name, p)] = percentile(values, p)
+            report.append(row)
+        return report
+
+def rounded(value, scale=1):
+    if value is None:
+        return None
+    return int(round(value * scale))
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values"""
+    if not values:
+        return None
+    return values[max(int(math.ceil(p / 100.0 * len(values))) - 1, 0)]
+
+def print_report(report, format):
+    if format == "json":
+        json.dump(report, sys.stdout, indent=1)
+        print()
+        return
+    columns = ["host", "probes", "good", "stale"] + [
+        "%s_p%d" % (name, p) for name in ("lag", "lag_seconds", "latency_ms")
+                              for p in (50, 90, 99)]
+    if format == "csv":
+        writer = csv.writer(sys.stdout)
+        writer.writerow(columns)
+        for row in report:
+            writer.writerow([row[c] for c in columns])
+        return
+    for row in report:
+        print(row["host"])
+        print("  probes: %(probes)d, good: %(good)d, stale: %(stale)d" % row)
+        for name, unit in (("lag", "publishes"), ("lag_seconds", "seconds"),
+                           ("latency_ms", "ms")):
+            print("  %-12s p50 %-8s p90 %-8s p99 %-8s (%s)" % (
+                name + ":", row[name + "_p50"], row[name + "_p90"],
+                row[name + "_p99"], unit))
+
+class Prober(object):
+    """Probe every host x tag x arch combination concurrently.
+
+    Each mirror host gets its own small thread pool, which caps the number
+    of in-flight requests per host; a single deadline bounds the whole run.
+    A host that fails to connect is excluded for the rest of the run and
+    its circuit breaker is tripped. Series/dvers a host is not known to
+    carry are only probed when their coverage is due for a recheck.
+
+    A mirror is fresh if its repomd.xml has the revision and primary
+    checksum of one of the last few revisions published locally. Probes
+    are GETs over pooled keep-alive connections, made conditional on the
+    validators cached from the previous run, and only parse as much of
+    repomd.xml as they need.
+
+    Mirrors that carry the manifest written by update_manifest.py are
+    judged from it with a single request, plus one repomd.xml probe as a
+    spot check that the manifest matches the repos beside it. Mirrors
+    without a manifest, or whose spot check disagrees, are probed repo by
+    repo.
+    """
+
+    def __init__(self, hosts, timeout, per_host, deadline, revisions, cache,
+                 health, coverage):
+        self.hosts = hosts
+        self.timeout = timeout
+        self.revisions = revisions
+        self.cache = cache
+        self.health = health
+        self.coverage = coverage
+        self.http = HTTPPool(timeout)
+        self.demoted = set()
+        self.per_host = per_host
+        self.deadline = time.monotonic() + deadline
+        self.dead = dict((host, threading.Event()) for host in hosts)
+
+    def remaining(self):
+        return self.deadline - time.monotonic()
+
+    def trips(self, error, timeout):
+        """Return whether a request error should open the host's circuit:
+        any connection failure, but a timeout only if it was not cut short
+        by the probe deadline"""
+        return not isinstance(error, socket.timeout) or timeout >= self.timeout
+
+    def check_health(self, host):
+        """Cheap reachability check for a half-open host"""
+        url = host+"/osg/"
+        timeout = min(self.timeout, self.remaining())
+        try:
+            response = self.http.request("HEAD", url, timeout=timeout)
+            if response.status < 500:
+                log("health check passed, closing circuit for "+host)
+                self.health.reset(host)
+                return True
+            error = "status "+str(response.status)
+        except Exception as e:
+            if not self.trips(e, timeout):
+                log("health check of "+url+" cut short by the probe deadline")
+                return False
+            error = str(e)
+        log("health check failed for "+url+" "+error)
+        self.health.trip(host, error)
+        return False
+
+    def usable_hosts(self):
+        """Filter self.hosts through the circuit breakers"""
+        usable = []
+        halfopen = []
+        for host in self.hosts:
+            state = self.health.state(host)
+            if state == "closed":
+                usable.append(host)
+            elif state == "half-open":
+                halfopen.append(host)
+            else:
+                entry = self.health.hosts[host]
+                log("circuit open for %s until %s (%d failures, last: %s)"
+                    % (host, time.ctime(entry["opened"] + entry["backoff"]),
+                       entry["failures"], entry.get("error")))
+        if halfopen:
+            with concurrent.futures.ThreadPoolExecutor(len(halfopen)) as pool:
+                healthy = list(pool.map(self.check_health, halfopen))
+            usable += [host for host, ok in zip(halfopen, healthy) if ok]
+        return [host for host in self.hosts if host in usable]
+
+    def probe(self, host, tag, arch):
+        """Probe host for tag/arch and return a result dict, or None if the
+        probe was skipped.
+
+        The result has the probe status (good, stale, old, missing or
+        error), the revision seen, how far behind it is in publishes and
+        seconds, and the request latency.
+        """
         url = mkarchurl(host,tag,arch)
-        mdurl=url+"/repodata/repomd.xml"
-        log("checking: "+mdurl)
+        mdurl = url+"/repodata/repomd.xml"
+        if self.dead[host].is_set():
+            return None
+        remaining = self.remaining()
+        if remaining <= 0:
+            log("skipping: "+mdurl+" (probe deadline reached)")
+            return None
+        cached = self.cache.get(mdurl)
+        headers = {}
+        if cached and cached.get("last_modified") and "revision" in cached:
+            headers["If-Modified-Since"] = cached["last_modified"]
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+        result = {"status": "error", "revision": None, "lag": None,
+                  "lag_seconds": None, "latency": None}
+        timeout = min(self.timeout, remaining)
         try:
-            response = urllib2.urlopen(mdurl, timeout=10)
-            if response.code != 200:
-                log("\tbad(non 200) response.code:"+response.code)
+            started = time.monotonic()
+            response = self.http.request("GET", mdurl, headers, timeout, reader=parse_repomd)
+            result["latency"] = time.monotonic() - started
+            if response.status == 304:
+                # unchanged since last run; re-judge the cached copy
+                self.cache.hit()
+                meta = cached
+            elif response.status == 404:
+                #no such repo on this host..
+                log("not found: "+mdurl)
+                self.cache.put(mdurl, {"verdict": "missing"})
+                self.coverage.update(host, tag, served=False)
+                result["status"] = "missing"
+                return result
+            elif response.status != 200:
+                log("bad(non 200) response.code:"+str(response.status)+" for "+mdurl)
+                return result
+            else:
+                meta = {"etag": response.getheader("ETag"),
+                        "last_modified": response.getheader("Last-Modified"),
+                        "revision": response.parsed["revision"],
+                        "primary": response.parsed["primary"]}
+            self.coverage.update(host, tag, served=True)
+            result["revision"] = meta["revision"]
+            #make sure the repository is up-to-date
+            history = self.revisions.get(tag, arch)
+            if history:
+                self.judge(history, meta, result)
+                why = "revision "+str(meta["revision"])+" is not one of the last %d published" % len(history)
             else:
-                #make sure the repository is up-to-date
-                lastmod_str = response.headers["Last-Modified"]
-                lastmodtime = time.strptime(lastmod_str, "%a, %d %b %Y %H:%M:%S %Z") #Thu, 15 Sep 2011 13:34:06 GMT
+                # nothing published here to compare against; go by age
+                lastmodtime = time.strptime(meta["last_modified"], "%a, %d %b %Y %H:%M:%S %Z") #Thu, 15 Sep 2011 13:34:06 GMT
                 age = (time.mktime(time.gmtime()) - time.mktime(lastmodtime))
-                if age > 3600 * threshold:
-                    log("\ttoo old ("+str(age)+" seconds old) Last-Modified: "+lastmod_str+" .. ignoring")
-                else:
-                    list.append(url)
-                    log("\tall good")
-        except urllib2.HTTPError,e:
-            #no such repo on this host..
-            log("\tURL caught while processing url:"+url+" "+str(e))
-        except urllib2.URLError,e:
-            # Error contacting the host. Remove it from the mirrorhosts for this run.
-            log("\tExcluding host due to connection error for url:"+url+" "+str(e))
-            mirrorhosts.remove(host)
-        except Exception, e:
-            log("\tException caught while processing url:"+url+" "+str(e))
-
-    return list
-
-log("evacuating live dir for osg")
-
-#replace previous mirror
-if os.path.exists("/usr/local/mirror/.osg.prev"):
-    shutil.rmtree("/usr/local/mirror/.osg.prev")
-
-if os.path.exists("/usr/local/mirror/.osg.new"):
-    os.rename("/usr/local/mirror/.osg.new", "/usr/local/mirror/.osg.prev")
-
-#point mirror to previous
-if os.path.lexists("/usr/local/mirror/osg"):
-    os.unlink("/usr/local/mirror/osg")
-
-os.symlink(".osg.prev", "/usr/local/mirror/osg")
-
-#create new mirror
-for tag in tags:
-    log("checking for "+tag)
-    series,dver,repo = tagsplit(tag)
-    repopath = '/'.join(["/usr/local/mirror/.osg.new",series,dver,repo])
-    os.makedirs(repopath)
-    for arch in archs:
-        list = test(mirrorhosts,tag,arch)
-        f = open(repopath + "/" + arch, "w")
-        for m in list:
-            f.write(m+"\n")
-        f.close()
-
-# SOFTWARE-4420: temporary upcoming symlink to 3.5-upcoming
-os.symlink("3.5-upcoming", "/usr/local/mirror/.osg.new/upcoming")
-
-#point mirror to new
-os.unlink("/usr/local/mirror/osg")
-os.symlink(".osg.new", "/usr/local/mirror/osg")
-
-log("all done")
+                result["status"] = "good" if age <= 3600 * threshold else "old"
+                why = "too old ("+str(age)+" seconds old) Last-Modified: "+meta["last_modified"]
+            good = result["status"] == "good"
+            self.cache.put(mdurl, dict(meta, verdict="good" if good else "old"))
+            if not good:
+                log(why+" .. ignoring "+mdurl)
+                return result
+            status = []
+            if response.status == 304:
+                status.append("not modified")
+            if result["lag"]:
+                status.append("%d publishes behind" % result["lag"])
+            log("all good"+(" (%s)" % ", ".join(status) if status else "")+": "+mdurl)
+        except OSError as e:
+            if not self.trips(e, timeout):
+                log("probe deadline reached while fetching "+mdurl)
+                return result
+            # Error contacting the host. Exclude it until its circuit closes.
+            log("Excluding host due to connection error for url:"+url+" "+str(e))
+            self.dead[host].set()
+            self.health.trip(host, str(e))
+        except Exception as e:
+            log("Exception caught while processing url:"+url+" "+str(e))
+        return result
+
+    def probe_manifest(self, host, matrix):
+        """Judge the tag/arches in matrix that host's manifest lists.
+
+        Return a list of (host, tag, arch, result) tuples, or None if the
+        host has to be probed repo by repo. A repo the manifest does not
+        list is left out: that says nothing about whether the host has it,
+        only that it was not published since the manifest was started.
+        """
+        url = host+"/osg/"+manifest
+        remaining = self.remaining()
+        if self.dead[host].is_set() or remaining <= 0:
+            return None
+        cached = self.cache.get(url)
+        headers = {}
+        if cached and cached.get("last_modified") and "repos" in cached:
+            headers["If-Modified-Since"] = cached["last_modified"]
+            if cached.get("etag"):
+                headers["If-None-Match"] = cached["etag"]
+        try:
+            response = self.http.request("GET", url, headers, min(self.timeout, remaining),
+                                         reader=read_json)
+            if response.status == 304:
+                self.cache.hit()
+                repos = cached["repos"]
+                check_manifest(repos)
+            elif response.status == 200:
+                repos = response.parsed["repos"]
+                check_manifest(repos)
+                self.cache.put(url, {"etag": response.getheader("ETag"),
+                                     "last_modified": response.getheader("Last-Modified"),
+                                     "repos": repos})
+            else:
+                log("no manifest on "+host+" (status "+str(response.status)
+                    +"), probing repo by repo")
+                return None
+        except Exception as e:
+            log("cannot use manifest "+url+": "+str(e)+", probing repo by repo")
+            return None
+
+        results = []
+        for tag, arch in matrix:
+            meta = repos.get(self.revisions.key(tag, arch))
+            if not meta:
+                continue
+            result = {"status": "error", "revision": meta["revision"], "lag": None,
+                      "lag_seconds": None, "latency": None}
+            history = self.revisions.get(tag, arch)
+            if history:
+                self.judge(history, meta, result)
+            else:
+                age = time.time() - meta["published"]
+                result["status"] = "good" if age <= 3600 * threshold else "old"
+            if result["status"] != "good":
+                log(result["status"]+" in manifest, revision "+str(meta["revision"])
+                    +" .. ignoring "+mkarchurl(host,tag,arch))
+            results.append((host, tag, arch, result))
+
+        # the manifest may have been synced before or after the repos
+        if results:
+            _, tag, arch, expected = random.choice(results)
+            spot = self.probe(host, tag, arch)
+            if spot is None or spot["status"] != expected["status"]:
+                log("manifest of %s says %s for %s, but its repomd.xml is %s; "
+                    "probing repo by repo" % (host, expected["status"],
+                    mkarchurl(host,tag,arch), spot and spot["status"]))
+                return None
+            expected["latency"] = spot["latency"]
+        for host, tag, arch, result in results:
+            self.coverage.update(host, tag, served=True)
+        log("manifest of %s: %d of %d listed repos good, %d not listed"
+            % (host, sum(r["status"] == "good" for h, t, a, r in results), len(results),
+               len(matrix) - len(results)))
+        return results
+
+    def judge(self, history, meta, result):
+        """Set the status and lag in result by finding meta in history.
+
+        A mirror serving a revision older than everything in history is
+        stale, and its lag is only a lower bound.
+        """
+        now = time.time()
+        for lag, rev in enumerate(history):
+            if (rev["revision"], rev["primary"]) == (meta["revision"], meta["primary"]):
+                result["status"] = "good"
+                result["lag"] = lag
+                # behind since the publish that replaced the revision it has
+                result["lag_seconds"] = now - history[lag - 1]["published"] if lag else 0
+                return
+        result["status"] = "stale"
+        result["lag"] = len(history)
+        result["lag_seconds"] = now - history[-1]["published"]
+
+    def run(self, matrix):
+        """Return a dict mapping each (tag, arch) in matrix to the list of
+        good hosts. The individual probe results are left in self.results
+        as (host, tag, arch, result) tuples."""
+        self.hosts = self.usable_hosts()
+        pools = dict((host, concurrent.futures.ThreadPoolExecutor(self.per_host))
+                     for host in self.hosts)
+        # decide what to probe before any probe can update the coverage
+        due = [(host, tag, arch) for tag, arch in matrix for host in self.hosts
+               if self.coverage.due(host, tag)]
+        self.results = []
+
+        manifests = dict((pools[host].submit(self.probe_manifest, host, matrix), host)
+                         for host in self.hosts)
+        done, not_done = concurrent.futures.wait(manifests,
+                                                 timeout=max(self.remaining(), 0))
+        judged = set()
+        for fut in done:
+            results = outcome(fut, "manifest probe of "+manifests[fut])
+            if results is not None:
+                self.results += results
+                judged.update((host, tag, arch) for host, tag, arch, result in results)
+        # repos a manifest does not list are probed one by one
+        due = [entry for entry in due if entry not in judged]
+        uncovered = len(matrix) * len(self.hosts) - len(judged) - len(due)
+
+        futures = {}
+        # submit repo by repo so all hosts make progress on the same repos
+        for host, tag, arch in due:
+            fut = pools[host].submit(self.probe, host, tag, arch)
+            futures[fut] = (host, tag, arch)
+        if uncovered:
+            log("skipping %d probes for series/dvers the hosts do not carry" % uncovered)
+
+        done, not_done = concurrent.futures.wait(futures,
+                                                 timeout=max(self.remaining(), 0))
+        if not_done:
+            log("probe deadline reached with %d probes outstanding" % len(not_done))
+            for fut in not_done:
+                fut.cancel()
+        # let requests in flight end, within their timeout, before the
+        # caller saves the state they update
+        for pool in pools.values():
+            pool.shutdown(wait=True)
+
+        for fut in done:
+            host, tag, arch = futures[fut]
+            result = outcome(fut, "probe of "+mkarchurl(host, tag, arch))
+            if result is None:
+                continue
+            self.results.append((host, tag, arch, result))
+
+        good = {}
+        for host, tag, arch, result in self.results:
+            if result["status"] == "good":
+                good.setdefault((tag, arch), set()).add(host)
+        return dict(((tag, arch), [h for h in self.hosts if h in good.get((tag, arch), ())])
+                    for tag, arch in matrix)
+
+    def validate(self, repodir, samples, size, budget):
+        """HEAD a sample of packages on mirrors judged good, within budget
+        requests, and demote mirrors for the repos whose sample is not whole.
+
+        Only mirrors at the revision published here are sampled, since the
+        packages come from the local primary metadata.
+        """
+        candidates = [(host, tag, arch) for host, tag, arch, result in self.results
+                      if result["status"] == "good" and result["lag"] == 0
+                      and host in self.hosts and not self.dead[host].is_set()]
+        random.shuffle(candidates)
+        candidates.sort(key=lambda c: not samples.failed(c[0], self.revisions.key(c[1], c[2])))
+        packages = {}
+        chosen = []
+        for host, tag, arch in candidates:
+            if budget < 1:
+                break
+            key = self.revisions.key(tag, arch)
+            if key not in packages:
+                primary = os.path.join(repodir, "osg", key,
+                                       self.revisions.get(tag, arch)[0].get("primary_href", ""))
+                try:
+                    packages[key] = read_packages(primary)
+                except Exception as e:
+                    log("cannot read packages of "+key+" from "+primary+": "+str(e))
+                    packages[key] = []
+            hrefs = random.sample(packages[key], min(size, budget, len(packages[key])))
+            if hrefs:
+                chosen.append((host, tag, arch, hrefs))
+                budget -= len(hrefs)
+
+        pools = dict((host, concurrent.futures.ThreadPoolExecutor(self.per_host))
+                     for host in self.hosts)
+        futures = dict((pools[host].submit(self.check_packages, host, tag, arch, hrefs),
+                        (host, tag, arch)) for host, tag, arch, hrefs in chosen)
+        done, not_done = concurrent.futures.wait(futures, timeout=max(self.remaining(), 0))
+        for fut in not_done:
+            fut.cancel()
+        for pool in pools.values():
+            pool.shutdown(wait=True)
+        for fut in done:
+            host, tag, arch = futures[fut]
+            result = outcome(fut, "package check of "+mkarchurl(host, tag, arch))
+            if result is not None:
+                samples.update(host, self.revisions.key(tag, arch), result)
+
+        for host, tag, arch, result in self.results:
+            if result["status"] == "good" and samples.failed(host, self.revisions.key(tag, arch)):
+                self.demoted.add((host, tag, arch))
+        log("sampled %d packages in %d repos, %d mirror repos demoted"
+            % (sum(len(c[3]) for c in chosen), len(chosen), len(self.demoted)))
+
+    def check_packages(self, host, tag, arch, hrefs):
+        """Return whether every package in hrefs is on host, or None if
+        that could not be told"""
+        url = mkarchurl(host,tag,arch)
+        for href in hrefs:
+            remaining = self.remaining()
+            if remaining <= 0 or self.dead[host].is_set():
+                return None
+            try:
+                response = self.http.request("HEAD", url+"/"+href,
+                                             timeout=min(self.timeout, remaining))
+            except Exception as e:
+                log("package check failed for "+url+"/"+href+" "+str(e))
+                return None
+            if response.status != 200:
+                log("package sample incomplete, status "+str(response.status)
+                    +" for "+url+"/"+href+" .. demoting")
+                return False
+        return True
+
+    def measure(self, performance):
+        """Feed this run's RTT and transfer rate of each host to performance.
+
+        The RTT is the median probe latency. The transfer rate comes from
+        fetching the primary metadata, of the size closest to
+        performance.size, of a repo the host has at the current revision.
+        """
+        for host in self.hosts:
+            latencies = [r["latency"] for h, tag, arch, r in self.results
+                         if h == host and r["latency"] is not None]
+            if latencies:
+                performance.update(host, "rtt", statistics.median(latencies))
+        if performance.size:
+            with concurrent.futures.ThreadPoolExecutor(len(self.hosts) or 1) as pool:
+                for host, rate in zip(self.hosts, pool.map(
+                        lambda host: self.transfer_rate(host, performance.size), self.hosts)):
+                    if rate:
+                        performance.update(host, "rate", rate)
+
+    def transfer_rate(self, host, size):
+        candidates = []
+        for h, tag, arch, result in self.results:
+            if h == host and result["status"] == "good" and result["lag"] == 0:
+                current = self.revisions.get(tag, arch)[0]
+                if current.get("primary_href") and current.get("primary_size"):
+                    candidates.append((abs(current["primary_size"] - size), tag, arch))
+        remaining = self.remaining()
+        if not candidates or remaining <= 0:
+            return None
+        _, tag, arch = min(candidates)
+        current = self.revisions.get(tag, arch)[0]
+        url = mkarchurl(host,tag,arch)+"/"+current["primary_href"]
+        try:
+            started = time.monotonic()
+            response = self.http.request("GET", url, timeout=min(self.timeout, remaining),
+                                         reader=count_bytes)
+            elapsed = time.monotonic() - started
+        except Exception as e:
+            log("transfer rate test failed for "+url+" "+str(e))
+            return None
+        if response.status != 200 or response.parsed != current["primary_size"]:
+            log("transfer rate test failed for "+url+": status "+str(response.status)
+                +", "+str(response.parsed)+" of "+str(current["primary_size"])+" bytes")
+            return None
+        rate = response.parsed / max(elapsed, 0.001)
+        log("transfer rate of %s: %.0f KiB/s" % (host, rate / 1024))
+        return rate
+
+    def close(self):
+        self.http.close()
+        log("%d requests over %d connections, %d not modified"
+            % (self.http.requests, self.http.connections, self.cache.hits))
+
+def main():
+    args = parse_args()
+
+    if args.report:
+        history = History(os.path.join(args.state_dir, "mirror-history.sqlite"))
+        print_report(history.report(time.time() - args.since * 24 * 3600), args.format)
+        return
+
+    # a full sweep waits out a --changed run; a --changed run leaves the
+    # journal to whichever run is in progress, or the next one
+    if args.changed and not lock(args.lock_file):
+        log("another run is in progress, leaving published tags to the next run")
+        return
+    if not args.changed and not lock(args.lock_file, lock_wait):
+        log("Script appears to already be running.")
+        sys.exit(1)
+
+    replicas = args.origins or origin_replicas()
+    hosts = [host for host in args.hosts or mirrorhosts if host not in replicas]
+    tagfile = open(args.tags_file, "r")
+    tags = [tag.rstrip("\n").split(":")[0] for tag in tagfile]
+    tags = sorted(set(tags))
+    tagfile.close()
+
+    matrix = [(tag, arch) for tag in tags for arch in repo_archs(args.repo_dir, tag)]
+
+    log("Using following parameters")
+    log("tags:"+str(tags))
+    log("origins:"+str(replicas))
+    log("hosts:"+str(hosts))
+    log("repos:"+str(len(matrix))+" (tag/arch combinations)")
+    log("order:"+args.order+" weights:"+str(parse_weights(args)))
+    log("revisions:"+str(args.revisions))
+    log("threshold:"+str(threshold)+" (hours)")
+    log("timeout:"+str(args.timeout)+" (seconds)")
+    log("per-host:"+str(args.per_host)+" (concurrent requests)")
+    log("deadline:"+str(args.deadline)+" (seconds)")
+
+    make_state_dir(args.state_dir)
+    # probe only what was published since the last run, and repos that
+    # have no mirrorlist yet
+    published = read_journal(os.path.join(args.state_dir, journal))
+    previous = load_state(os.path.join(args.state_dir, "mirrorlist.json"), None)
+    full = not (args.changed and previous)
+    if not full:
+        probed = [(tag, arch) for tag, arch in matrix if tag in published
+                  or '/'.join(tagsplit(tag) + (arch,)) not in previous["repos"]]
+        if not probed:
+            log("no repos published since the last run")
+            return
+        log("published since the last run:"+str(sorted(published)))
+    else:
+        if args.changed:
+            log("no previous mirrorlists, probing all repos")
+        probed = matrix
+
+    revisions = Revisions(os.path.join(args.state_dir, "mirror-revisions.json"),
+                          args.revisions)
+    revisions.update(args.repo_dir, probed, prune=full)
+    revisions.save()
+    cache = ProbeCache(os.path.join(args.state_dir, "mirror-probe-cache.json"))
+    health = HostHealth(os.path.join(args.state_dir, "mirror-health.json"))
+    coverage = Coverage(os.path.join(args.state_dir, "mirror-coverage.json"),
+                        args.recheck * 3600)
+    performance = Performance(os.path.join(args.state_dir, "mirror-performance.json"),
+                              args.calibrate_size)
+    samples = Samples(os.path.join(args.state_dir, "mirror-samples.json"))
+
+    started = time.monotonic()
+    prober = Prober(replicas + hosts, args.timeout, args.per_host, args.deadline,
+                    revisions, cache, health, coverage)
+    results = prober.run(probed)
+    if full:
+        prober.measure(performance)
+    if args.sample_budget > 0:
+        prober.validate(args.repo_dir, samples, args.sample, args.sample_budget)
+        samples.save()
+    prober.close()
+    cache.save()
+    health.save()
+    coverage.save()
+    performance.save()
+    History(os.path.join(args.state_dir, "mirror-history.sqlite")).record(prober.results)
+    log("probed %d repos on %d hosts in %.1f seconds"
+        % (len(results), len(prober.hosts), time.monotonic() - started))
+
+    #create new mirror, while the current one stays live
+    generation = Generation(args.mirror_dir)
+    weights = parse_weights(args)
+    speed = performance.speed(replicas + hosts)
+    epoch = int(time.time() // (reshuffle * 3600))
+    index = {}
+    for tag, arch in matrix:
+        series,dver,repo = tagsplit(tag)
+        key = '/'.join([series,dver,repo,arch])
+        if (tag, arch) in results:
+            good = performance.order(results[(tag, arch)])
+            # always include the origin in list, all of its replicas if
+            # none of them passed
+            up = [host for host in good if host in replicas] or replicas
+            entries = [(mkarchurl(host,tag,arch), weights.get(host, weights["origin"]) * speed[host])
+                       for host in up if (host, tag, arch) not in prober.demoted]
+            entries += [(mkarchurl(host,tag,arch), weights.get(host, 1) * speed[host])
+                        for host in good if host not in replicas
+                        and (host, tag, arch) not in prober.demoted]
+            # hosts missing sampled packages are only tried last
+            entries += [(mkarchurl(host,tag,arch), 0)
+                        for host in good if (host, tag, arch) in prober.demoted]
+        else:
+            # not probed in this run; keep the last run's mirrors
+            entries = [tuple(entry) for entry in previous["repos"][key]]
+        if args.order == "weighted":
+            # same order for the same hosts until the next reshuffle, so
+            # unchanged files can be reused
+            seed = "%s %s %d" % (key, " ".join(url for url, weight in entries), epoch)
+            list = weighted_order(entries, random.Random(seed))
+        else:
+            list = [url for url, weight in entries]
+        generation.write(key, "".join(m+"\n" for m in list))
+        # only repos published here have the hashes a metalink needs
+        history = revisions.get(tag, arch)
+        if history and "sha256" in history[0]:
+            generation.write(key + ".metalink", metalink(history, list))
+        index[key] = [[url, round(weight, 3)] for url, weight in entries]
+
+    # SOFTWARE-4420: temporary upcoming symlink to 3.5-upcoming
+    generation.symlink("3.5-upcoming", "upcoming")
+
+    #point mirror to new
+    generation.commit()
+
+    # for mirrorlist_server.py, which reloads it when it is replaced
+    save_state(os.path.join(args.state_dir, "mirrorlist.json"),
+               {"generated": time.time(), "repos": index,
+                "order": args.order,
+                "aliases": {"upcoming": "3.5-upcoming"}})
+
+    log("all done")
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,15 @@
 #!/bin/bash
 OSGTAGS=/etc/osg-koji-tags/osg-tags
 
+# Wall-clock budget of each phase, for timeout(1); a phase that runs over
+# is killed along with its children, and the tag fails
+MASH_TIMEOUT=${MASH_TIMEOUT:-2h}
+CONDOR_SYNC_TIMEOUT=${CONDOR_SYNC_TIMEOUT:-30m}
+CREATEREPO_TIMEOUT=${CREATEREPO_TIMEOUT:-30m}
+REPOVIEW_TIMEOUT=${REPOVIEW_TIMEOUT:-30m}
+ROTATE_TIMEOUT=${ROTATE_TIMEOUT:-10m}
+KILL_AFTER=${KILL_AFTER:-1m}  # from SIGTERM to SIGKILL
+
 usage () {
   echo "Usage: $(basename "$0") TAG"
   echo "Where:"
@@ -16,6 +25,21 @@ usage () {
 [[ $# -eq 1 ]] || usage
 TAG=$1
 
+# run PHASE BUDGET COMMAND... : run COMMAND within BUDGET, failing the tag
+# if it runs over; otherwise return its exit status. Commands don't get
+# the lock fd, so nothing left behind can hold the lock.
+run () {
+  local phase=$1 budget=$2
+  shift 2
+  timeout --kill-after="$KILL_AFTER" "$budget" "$@" 99>&-
+  local ret=$?
+  if [[ $ret = 124 || $ret = 137 ]]; then
+    echo "$phase for $TAG timed out after $budget" >&2
+    exit 1
+  fi
+  return $ret
+}
+
 case $TAG in
   osg-*-*-*-* ) IFS='-' read osg SERIES branch DVER REPO <<< "$TAG"
                          SERIES+=-$branch ;;
@@ -55,40 +79,69 @@ if test -d $release_path && grep -q $TAG $OSGTAGS.create-only ; then
   exit 0
 fi
 
+# On failure, or when killed, drop the partial working copy, and put the
+# release back if it was already rotated out
+cleanup () {
+  local ret=$?
+  if [[ $ret != 0 ]]; then
+    [[ -e $release_path || ! -e $previous_path ]] || mv "$previous_path" "$release_path"
+    rm -rf "$working_path/$reponame"
+  fi
+  exit $ret
+}
+trap cleanup EXIT
+trap 'exit 143' TERM
+trap 'exit 130' INT
+
 mkdir -p "$release_path" "$working_path" "$previous_path"
-mash "$reponame" -o "$working_path" -p "$release_path"
+# left behind by a run that was killed outright
+rm -rf "$working_path/$reponame"
+run mash "$MASH_TIMEOUT" mash "$reponame" -o "$working_path" -p "$release_path"
 
 if [ "$?" -ne "0" ]; then
         echo "mash failed - please see error log" >&2
         exit 1
 fi
 
-pull_condor_rpms.sh $TAG $repo_working_path $repo_release_path ''
+run "condor sync" "$CONDOR_SYNC_TIMEOUT" \
+  pull_condor_rpms.sh $TAG $repo_working_path $repo_release_path ''
 CONDOR_SYNC_EXIT=$?
 # Copy relevant htcondor rpms to the working directory, if any
 case $CONDOR_SYNC_EXIT in
-  0 ) createrepo --update $repo_working_path
-      repoview $repo_working_path ;;
+  0 ) run createrepo "$CREATEREPO_TIMEOUT" createrepo --update $repo_working_path
+      run repoview "$REPOVIEW_TIMEOUT" repoview $repo_working_path ;;
   1 ) echo "Error: Condor repo sync failed"
       exit 1 ;;
   * ) echo "Nothing to be done for condor repo sync" ;;
 esac
 
-pull_condor_rpms.sh $TAG $repo_working_srpm_path $repo_release_srpm_path 'SRPMS/'
+run "condor srpm sync" "$CONDOR_SYNC_TIMEOUT" \
+  pull_condor_rpms.sh $TAG $repo_working_srpm_path $repo_release_srpm_path 'SRPMS/'
 CONDOR_SRPM_SYNC_EXIT=$?
 # Copy relevant htcondor srpms to the working directory, if any
 case $CONDOR_SRPM_SYNC_EXIT in
-  0 ) createrepo --update $repo_working_srpm_path
-      repoview $repo_working_srpm_path ;;
+  0 ) run createrepo "$CREATEREPO_TIMEOUT" createrepo --update $repo_working_srpm_path
+      run repoview "$REPOVIEW_TIMEOUT" repoview $repo_working_srpm_path ;;
   1 ) echo "Error: Condor srpm repo sync failed" 
       exit 1 ;;
   * ) echo "Nothing to be done for condor srpm repo sync" ;;
 esac
 
-rm -rf "$previous_path"
+run rotate "$ROTATE_TIMEOUT" rm -rf "$previous_path"
 mv "$release_path" "$previous_path"
 mv "$working_path/$reponame" "$release_path"
 
+# Record the new repomd revisions in the manifest the mirror prober reads
+if ! update_manifest.py "$TAG"; then
+        echo "Warning: could not update the repo manifest for $TAG" >&2
+fi
+
+# Queue the tag for update_mirror.py --changed
+journal=/var/lib/repo/published-tags
+# resolve it, since /var/lib/repo may be a symlink to a directory not yet created
+mkdir -p "$(readlink -m "$(dirname "$journal")")"
+( flock 98 && echo "$(date +%s) $TAG" >&98 ) 98>>"$journal"
+
 if [[ $REPO = release && $SERIES != *-upcoming ]]; then
         echo "creating osg-$SERIES-$DVER-release-latest symlink"
         cd /usr/local/repo/osg/"$SERIES"
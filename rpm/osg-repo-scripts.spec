@@ -12,6 +12,7 @@ BuildArch:	noarch
 #BuildRequires:	
 Requires:	mash
 Requires:	repoview
+Requires:	python3
 # does not work with createrepo 0.9.9-26 from EPEL
 Requires:	createrepo >= 0.9.9-24
 Requires:	createrepo <  0.9.9-25
@@ -31,6 +32,7 @@ install -d $RPM_BUILD_ROOT%{_sysconfdir}/cron.d/
 install -d $RPM_BUILD_ROOT%{_sysconfdir}/mash/
 install -d $RPM_BUILD_ROOT%{_sysconfdir}/osg-koji-tags/
 install -d $RPM_BUILD_ROOT%{_usr}/local/mirror/
+install -d $RPM_BUILD_ROOT%{_sharedstatedir}/repo/
 install -d $RPM_BUILD_ROOT%{_datadir}/repo/
 
 install -m 0755 bin/new_mashfile.sh     $RPM_BUILD_ROOT%{_bindir}/
@@ -38,8 +40,12 @@ install -m 0755 bin/update_all_repos.sh $RPM_BUILD_ROOT%{_bindir}/
 install -m 0755 bin/update_mashfiles.sh $RPM_BUILD_ROOT%{_bindir}/
 install -m 0755 bin/update_mirror.py    $RPM_BUILD_ROOT%{_bindir}/
 install -m 0755 bin/update_repo.sh      $RPM_BUILD_ROOT%{_bindir}/
+install -m 0755 bin/mirrorlist_server.py $RPM_BUILD_ROOT%{_bindir}/
+install -m 0755 bin/update_manifest.py $RPM_BUILD_ROOT%{_bindir}/
+install -m 0755 bin/repo_scheduler.py  $RPM_BUILD_ROOT%{_bindir}/
 
 install -m 0644 etc/cron.d/repo      $RPM_BUILD_ROOT%{_sysconfdir}/cron.d/
+install -m 0644 etc/repo-schedule.conf $RPM_BUILD_ROOT%{_sysconfdir}/
 install -m 0644 etc/mash_koji_config $RPM_BUILD_ROOT%{_sysconfdir}/
 install -m 0644 etc/osg-koji-tags/osg-tags.exclude \
                        $RPM_BUILD_ROOT%{_sysconfdir}/osg-koji-tags/
@@ -58,14 +64,19 @@ install -m 0644 share/repo/mash.template $RPM_BUILD_ROOT%{_datadir}/repo/
 %{_bindir}/update_mashfiles.sh
 %{_bindir}/update_mirror.py
 %{_bindir}/update_repo.sh
+%{_bindir}/mirrorlist_server.py
+%{_bindir}/update_manifest.py
+%{_bindir}/repo_scheduler.py
 %{_datadir}/repo/mash.conf
 %{_datadir}/repo/mash.template
 %{_datadir}/repo/rsyncd.conf
 %config(noreplace) %{_sysconfdir}/cron.d/repo
 %config(noreplace) %{_sysconfdir}/mash_koji_config
+%config(noreplace) %{_sysconfdir}/repo-schedule.conf
 %config(noreplace) %{_sysconfdir}/osg-koji-tags/osg-tags.exclude
 %ghost             %{_sysconfdir}/osg-koji-tags/osg-tags
 %dir               %{_usr}/local/mirror
+%dir               %{_sharedstatedir}/repo
 
 %changelog
 * Wed Feb 10 2021 Carl Edquist <edquist@cs.wisc.edu> - 1.9.1-1
@@ -0,0 +1,97 @@
+import math
+import os
+import sys
+import tempfile
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "bin"))
+
+from repo_scheduler import Admission, Job, PeakRSS, Scheduler, Updated, due_tags
+
+
+class FixedSchedule(object):
+    def __init__(self, priority, max_age):
+        self.rule = (priority, max_age)
+
+    def lookup(self, tag):
+        return self.rule
+
+
+class DueTagsTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.updated = Updated(os.path.join(self.dir.name, "tag-updated.json"))
+        now = time.time()
+        self.updated.update("fresh", now - 60)
+        self.updated.update("stale", now - 3 * 1800)
+        self.schedule = FixedSchedule(1, 1800)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def due(self, lookahead):
+        return {tag: lateness for tag, priority, lateness in
+                due_tags(["fresh", "stale", "new"], self.schedule, self.updated, lookahead)}
+
+    def test_skips_fresh_tags(self):
+        self.assertEqual(self.due(0), {"stale": 3, "new": math.inf})
+
+    def test_lookahead_catches_tags_due_before_the_next_run(self):
+        self.assertEqual(set(self.due(1800)), {"fresh", "stale", "new"})
+
+    def test_infinite_lookahead_takes_every_tag(self):
+        # what --all and tags named on the command line use
+        self.assertEqual(set(self.due(math.inf)), {"fresh", "stale", "new"})
+
+
+class FixedAdmission(Admission):
+    """Admission with a fixed amount of memory and no load or pressure"""
+
+    def __init__(self, available, mem_reserve):
+        Admission.__init__(self, math.inf, math.inf, mem_reserve)
+        self.available = available
+
+    def mem_available(self):
+        return self.available
+
+    def pressure(self, resource):
+        return None
+
+
+class AdmissionTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.peaks = PeakRSS(os.path.join(self.dir.name, "tag-rss.json"), 1 << 30)
+        # a shrinking peak is smoothed to a float
+        self.peaks.update("big", 2 << 30)
+        self.peaks.update("big", 1 << 30)
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_holds_for_memory_with_smoothed_peaks(self):
+        admission = FixedAdmission(2 << 30, 512 << 20)
+        reason = admission.check(self.peaks.predict("big"), 0.5 * (1 << 20))
+        self.assertRegex(reason, r"^\d+ MiB free, \d+ MiB needed$")
+
+    def test_admits_with_enough_memory(self):
+        admission = FixedAdmission(8 << 30, 512 << 20)
+        self.assertIsNone(admission.check(self.peaks.predict("big"), 0))
+
+    def test_scheduler_holds_while_running_tags_may_grow(self):
+        admission = FixedAdmission(3 << 30, 512 << 20)
+        scheduler = Scheduler("update_repo.sh", 2, 0, None, None, admission, self.peaks)
+        running = Job("big")
+        running.rss = 256 << 20
+        scheduler.running["big"] = running
+        # the median peak is predicted for a tag never seen
+        self.assertFalse(scheduler.admit(Job("other")))
+        self.assertEqual(scheduler.held, "other")
+        admission.available = 8 << 30
+        self.assertTrue(scheduler.admit(Job("other")))
+        self.assertIsNone(scheduler.held)
+
+
+if __name__ == "__main__":
+    unittest.main()